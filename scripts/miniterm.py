@@ -242,34 +242,40 @@ class Miniterm(object):
         """loop and copy serial->console"""
         try:
             while self.alive and self._reader_alive:
-                data = character(self.serial.read(1))
+                # block for one byte, then take whatever else has arrived
+                data = self.serial.read(1)
+                if not data:
+                    continue
+                n = self.serial.inWaiting()
+                if n:
+                    data = data + self.serial.read(n)
+                data = character(data)
 
                 if self.repr_mode == 0:
                     # direct output, just have to care about newline setting
-                    if data == '\r' and self.convert_outgoing == CONVERT_CR:
-                        sys.stdout.write('\n')
-                    else:
-                        sys.stdout.write(data)
+                    if self.convert_outgoing == CONVERT_CR:
+                        data = data.replace('\r', '\n')
+                    sys.stdout.write(data)
                 elif self.repr_mode == 1:
                     # escape non-printable, let pass newlines
-                    if self.convert_outgoing == CONVERT_CRLF and data in '\r\n':
-                        if data == '\n':
-                            sys.stdout.write('\n')
-                        elif data == '\r':
-                            pass
-                    elif data == '\n' and self.convert_outgoing == CONVERT_LF:
-                        sys.stdout.write('\n')
-                    elif data == '\r' and self.convert_outgoing == CONVERT_CR:
-                        sys.stdout.write('\n')
-                    else:
-                        sys.stdout.write(repr(data)[1:-1])
+                    text = []
+                    for c in data:
+                        if self.convert_outgoing == CONVERT_CRLF and c in '\r\n':
+                            if c == '\n':
+                                text.append('\n')
+                        elif c == '\n' and self.convert_outgoing == CONVERT_LF:
+                            text.append('\n')
+                        elif c == '\r' and self.convert_outgoing == CONVERT_CR:
+                            text.append('\n')
+                        else:
+                            text.append(repr(c)[1:-1])
+                    sys.stdout.write(''.join(text))
                 elif self.repr_mode == 2:
                     # escape all non-printable, including newline
-                    sys.stdout.write(repr(data)[1:-1])
+                    sys.stdout.write(''.join([repr(c)[1:-1] for c in data]))
                 elif self.repr_mode == 3:
                     # escape everything (hexdump)
-                    for c in data:
-                        sys.stdout.write("%s " % c.encode('hex'))
+                    sys.stdout.write(''.join(["%s " % c.encode('hex') for c in data]))
                 sys.stdout.flush()
         except serial.SerialException, e:
             self.alive = False
@@ -1,6 +1,9 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """
-usage 'pinhole port host [newport]'
+usage 'pinhole [options] listen host [newport]'
+      'pinhole [options] --backend host[:port] ... listen'
+      'pinhole [options] --config FILE'
+      'pinhole bench [bench options] [options]'
 
 Pinhole forwards the port to the host specified.
 The optional newport parameter may be used to
@@ -12,85 +15,3466 @@ eg. pinhole 80 webserver
     pinhole 23 localhost 2323
     Forward all telnet sessions to port 2323 on localhost.
 
+    pinhole --engine async 80 webserver
+    Forward on a single event loop thread instead of
+    two threads per session.
+
+    pinhole --backend web1 --backend web2:8080 --balance leastconn 80
+    Spread WWW sessions over two webservers.
+
+    pinhole 127.0.0.1:8080 /run/app.sock
+    Forward local connections to a unix socket.
+
+listen is a port, which listens on every IPv4 and IPv6 address
+where the host has IPv6, an addr:port or [v6addr]:port to listen
+on one address, or a path to listen on a unix socket. Targets
+are host[:port], [v6addr]:port, or a unix socket path; host
+names resolve to whichever address family getaddrinfo() puts
+first. Unix sockets don't work with --udp, and unix listeners
+don't work with --workers.
+
+On Linux data is moved between the two sockets with splice(2)
+so it never gets copied through Python. Pinhole falls back to
+a plain recv/send loop where splice is not available, or when
+--no-splice is given. The userspace loop reads into a reusable
+buffer of --bufsize bytes per direction, so it allocates nothing
+once a session is running.
+
+--workers N forks N processes that each bind their own
+SO_REUSEPORT listener, so the kernel spreads new connections
+across cores. The parent restarts any worker that dies.
+
+Pending connections are drained in batches and the upstream
+connect never runs on the accept path, so a slow backend can't
+hold up new clients. --backlog sets the listen queue length for
+connection storms.
+
+--pool N keeps N idle upstream connections open ahead of time
+and hands them to new clients, saving the connect round trip.
+Idle connections older than --pool-idle seconds, or that the
+backend has closed, are evicted and replaced.
+
+The target host is resolved once and cached for --dns-ttl
+seconds. Refreshes happen in the background and if one fails
+the last known address keeps being used. Send SIGUSR1 to log
+stats for every listener, including the DNS cache hit rate.
+
+With more than one backend each session goes to the next one in
+turn (--balance roundrobin), to the one with the fewest active
+sessions (leastconn), or to one picked by a consistent hash of
+the client address (hash). Backends are probed with a TCP
+connect every --health-interval seconds; ones that fail
+HEALTH_FALL probes in a row get no new sessions until they pass
+HEALTH_RISE probes again.
+
+--metrics [host:]port (or a unix socket path) serves counters in
+Prometheus text format over HTTP: accepts, active and closed
+sessions, bytes each way, upstream connect latency, errors by
+type, backend health and per-session byte counts. With --workers
+each worker serves on the next port (or path.N) after the one
+given.
+
+Logging goes through a bounded queue to a background writer, so
+a burst of connections never waits on stdout. --log-level picks
+what is logged, --log-sample N keeps one in N session open/close
+events, --log-json writes one JSON object per line and
+--log-file writes somewhere other than stdout. Records are
+dropped (and counted) if the writer falls LOG_QUEUE behind.
+
+When one side finishes sending, pinhole shuts down the write
+side of the other socket and keeps relaying the other direction
+until it finishes too, then closes both. An error on either side
+tears the whole session down. --idle-timeout closes sessions that
+moved no data for that many seconds and --session-timeout caps
+how long any session may live.
+
+--rate-session, --rate-client and --rate-global cap bytes per
+second (both directions together) for each session, for all
+sessions from one client address, and for the whole process.
+They are token buckets checked by the relay loop itself: a pipe
+that overspends sleeps before passing the data on, so a bulk
+transfer can't starve the other sessions. Time spent throttled
+is in the stats and metrics.
+
+--max-sessions caps the TCP sessions open in the whole process,
+--max-client-sessions the ones open from any one client address,
+and --client-conn-rate how many new connections per second one
+client address may make. A connection over a limit is refused
+with a reset straight after accept() (--overflow reject), or held
+in a queue of up to ADMISSION_QUEUE connections until a slot is
+free (--overflow queue), and refused if none frees up within
+--queue-timeout seconds. Either way no thread or task is spent on
+it, so one greedy client can't run the process out of fds and
+threads. Refusals are counted as admission errors. With --workers
+--max-sessions is split between the workers, the per client
+limits apply in each worker.
+
+--high-water caps the bytes of one session direction waiting to
+be sent, in pinhole's buffer and the receiving socket's kernel
+queue together. Pinhole sets TCP_NOTSENT_LOWAT to --low-water
+(half the high mark by default) on both sockets so writes only
+go through once the receiver has drained below it, and reads at
+most the difference, so a fast sender can't pile data up behind
+a slow receiver. --memory-budget caps the relay buffers of every
+session together: buffers are then lent out only while a pipe
+has data to move, pipes wait for one when the budget is spent,
+and spares are kept only while they fit, so RSS stays flat under
+any number of sessions. Buffered bytes, their peak and the time
+spent waiting are in the stats and metrics. Spliced data never
+enters the process and isn't counted.
+
+--client-tcp and --backend-tcp tune the sockets on each side
+with a comma separated list of:
+    nodelay              disable Nagle, for small RPC messages
+    quickack             ack every read at once instead of delaying
+    keepalive[=I[:N[:C]]] probe after I idle seconds, every N
+                         seconds, giving up after C misses
+    rcvbuf=SIZE          kernel receive buffer, eg. 4m for bulk
+    sndbuf=SIZE          kernel send buffer
+    fastopen[=QLEN]      TCP_FASTOPEN on the listener, or
+                         TCP_FASTOPEN_CONNECT upstream
+eg. pinhole --client-tcp nodelay,quickack --backend-tcp nodelay,fastopen 6379 cache
+
+--proxy-protocol 1 or 2 starts every upstream connection with a
+PROXY protocol header (the text v1 or binary v2 format) carrying
+the client's address and port, so backends that understand it
+(haproxy, nginx, ...) see who the client really is. Clients on a
+unix socket are sent as UNKNOWN. TCP only.
+
+--capture PATH tees every TCP session's data to disk for
+debugging backends without running tcpdump alongside. PATH is a
+directory that gets an ID-CLIENT-PORT.in and .out file per
+session holding the raw bytes each way, or if it ends in .pcapng
+a single capture file with IP and TCP headers made up around the
+data (checksums left zero) that wireshark can follow as streams.
+Files move to NAME.1 once they grow past --capture-size and a
+new one is started. Copies go through a queue to a writer thread,
+so a slow disk never holds up the relay: once CAPTURE_QUEUE
+chunks are waiting new ones are dropped and counted. Captured
+sessions are copied through userspace instead of spliced. With
+--workers each worker writes to its own PATH with .N added before
+any extension.
+
+--udp forwards datagrams instead. Each client address gets a flow
+with its own connected upstream socket, so replies find their way
+back, and flows that see no traffic for --idle-timeout seconds
+(UDP_IDLE by default) are closed. Up to UDP_BATCH datagrams are
+drained per wakeup. UDP always runs on the event loop; shaping,
+pooling, health checks and the TCP options don't apply to it.
+
+    pinhole --udp 53 resolver
+    Forward DNS queries to resolver.
+
+--config FILE reads any number of listeners from an INI file, or
+TOML if the name ends in .toml, and serves them all from one
+process sharing one event loop and one metrics endpoint. Each
+section is named after its listen port and holds long options
+for that listener, which override the command line ones:
+
+    [8080]                      [8080]
+    backend = web1 web2:8080    backend = [ "web1", "web2:8080" ]
+    balance = leastconn         balance = "leastconn"
+
+    [5353]                      [5353]
+    backend = resolver:53       backend = [ "resolver:53" ]
+    udp = yes                   udp = true
+
+Process wide options (logging, --metrics, --workers and the
+client and global rates) are only read from the command line.
+SIGHUP rereads the file: new ports start listening, removed ones
+stop, and changed ones switch to their new backends. Sessions
+already open carry on where they were until they finish.
+
+SIGTERM or ^C drains: every listener stops accepting and pinhole
+exits once the open sessions finish, or after --drain-timeout
+seconds, whichever is first. A second signal exits at once.
+
+--handoff PATH allows upgrades without refusing or resetting a
+single connection. pinhole listens on the unix socket PATH, and a
+new pinhole started with the same --handoff connects to it first
+and is passed the listening sockets over SCM_RIGHTS. The old
+process then drains as above while the new one accepts.
+
+    pinhole --handoff /run/pinhole.sock --config pinhole.ini &
+    (deploy the new version)
+    pinhole --handoff /run/pinhole.sock --config pinhole.ini &
+
+pinhole bench starts a local echo server and a pinhole in front
+of it with the options given, then for --duration seconds each
+runs --clients concurrent clients through three tests: bulk
+(stream into a sink as fast as possible), rps (--size byte
+request/response round trips on open connections) and connect
+(a new connection per round trip). It prints throughput, rates
+and p50/p99 latencies, the forwarder's CPU time, and the same as
+one line of JSON at the end. --direct skips the forwarder to get
+a baseline. The clients share one event loop, so compare runs on
+the same machine rather than reading the numbers as absolutes.
+
+    pinhole bench --engine thread --no-splice
+    pinhole bench --engine async --tests rps,connect --clients 64
+
+Imported as a module, Forwarder runs one listener from Python,
+on an event loop thread of its own or inside a running asyncio
+loop, so a test harness can run any number of forwarders in one
+process instead of spawning a pinhole for each:
+
+    with pinhole.Forwarder( 0, 'localhost', 5432, engine = 'async' ) as fwd:
+        db = connect( *fwd.address )
+        ...
+        print( fwd.stats()['bytes_in'] )
+
 """
 
 import sys
-from socket import *
+import socket
+import stat
 from threading import Thread
+import argparse
+import asyncio
+import atexit
+import bisect
+import collections
+import configparser
+import copy
+import errno
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import select
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingUnixStreamServer
 import time
 import signal
 import os
+import struct
+import subprocess
+import zlib
+
+from logging import DEBUG, INFO, WARNING
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+
+LOGGER = logging.getLogger( 'pinhole' )
+# records waiting for the writer thread before new ones are dropped
+LOG_QUEUE = 10000
+# ( pid, QueueListener ) of the running log writer
+LOG_WRITER = None
+
+
+def log( msg, *args, level = INFO, sample = False, **fields ):
+    """queue a log record, formatting is left to the writer thread"""
+    if LOGGER.isEnabledFor( level ):
+        LOGGER.log( level, msg, *args, extra = { 'fields': fields, 'sample': sample })
+
+
+class TextFormatter( logging.Formatter ):
+    def format( self, record ):
+        return '%s:%s' % ( time.ctime( record.created ), record.getMessage() )
+
+
+class JSONFormatter( logging.Formatter ):
+    def format( self, record ):
+        entry = {
+            'time': round( record.created, 6 ),
+            'level': record.levelname.lower(),
+            'msg': record.getMessage(),
+        }
+        entry.update( getattr( record, 'fields', {} ))
+        return json.dumps( entry, default = str )
+
+
+class Sampler( logging.Filter ):
+    """let through one in every n records marked sample"""
+    def __init__( self, n ):
+        logging.Filter.__init__( self )
+        self.n = n
+        self.seen = itertools.count()
+
+    def filter( self, record ):
+        return not getattr( record, 'sample', False ) or next( self.seen ) % self.n == 0
+
+
+class DroppingQueueHandler( logging.handlers.QueueHandler ):
+    """never blocks the caller, drops and counts records when the queue is full"""
+    dropped = 0
+
+    def prepare( self, record ):
+        # the writer thread formats, callers only pay for the enqueue
+        return record
+
+    def enqueue( self, record ):
+        try:
+            self.queue.put_nowait( record )
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
+def start_logging( opts ):
+    """(re)start the background log writer, call again after fork"""
+    global LOG_WRITER
+    stop_logging()
+    stream = open( opts.log_file, 'a' ) if opts.log_file else sys.stdout
+    writer = logging.StreamHandler( stream )
+    writer.setFormatter( JSONFormatter() if opts.log_json else TextFormatter() )
+    q = queue.Queue( LOG_QUEUE )
+    handler = DroppingQueueHandler( q )
+    if opts.log_sample > 1:
+        handler.addFilter( Sampler( opts.log_sample ))
+    LOGGER.handlers = [ handler ]
+    LOGGER.setLevel( opts.log_level.upper() )
+    LOGGER.propagate = False
+    listener = logging.handlers.QueueListener( q, writer )
+    listener.start()
+    LOG_WRITER = ( os.getpid(), listener )
+    # flush what's queued on a normal exit
+    atexit.register( stop_logging )
+
+
+def stop_logging():
+    """write out what's queued and stop the log writer, for exits that skip atexit too"""
+    global LOG_WRITER
+    # a writer started before fork has no thread in this process
+    if LOG_WRITER and LOG_WRITER[0] == os.getpid():
+        LOG_WRITER[1].stop()
+    LOG_WRITER = None
+
+
+BUFSIZE = 1 << 16
+# connections accepted per listener wakeup before yielding to other work
+ACCEPT_BATCH = 256
+# seconds between upstream pool health checks
+POOL_CHECK = 1.0
+
+# backend health probes, consecutive results needed to eject or restore
+HEALTH_TIMEOUT = 2.0
+HEALTH_FALL = 3
+HEALTH_RISE = 2
+# points per backend on the consistent hash ring
+HASH_REPLICAS = 100
+
+# connections --overflow queue holds at most, and seconds between deadline checks
+ADMISSION_QUEUE = 1024
+ADMISSION_CHECK = 0.1
+# seconds between sweeps of idle per client admission state
+ADMISSION_SWEEP = 10.0
+
+# chunks of session data waiting for the capture writer before new ones are dropped
+CAPTURE_QUEUE = 256
+# payload per made up pcapng packet, so the IP length fits in 16 bits
+CAPTURE_SEGMENT = 65000
+# pcapng block types and the link type for packets that start at the IP header
+PCAPNG_SECTION = 0x0A0D0D0A
+PCAPNG_INTERFACE = 1
+PCAPNG_PACKET = 6
+LINKTYPE_RAW = 101
+# tcp flags for the made up packets
+TCP_FIN, TCP_SYN, TCP_RST, TCP_PSH, TCP_ACK = 1, 2, 4, 8, 16
+
+# seconds Forwarder.stop() waits for aborted sessions to close
+STOP_TIMEOUT = 5.0
+
+# seconds between scans for sessions past their timeouts
+REAP_INTERVAL = 1.0
+# seconds between checks for the last session while draining
+DRAIN_CHECK = 0.1
+
+# listener handoff: seconds to wait on the other process, message and fd limits
+HANDOFF_TIMEOUT = 5.0
+HANDOFF_MSG = 1 << 16
+HANDOFF_MAX_FDS = 1024
+
+# pending TCP fast open requests the listener keeps by default
+FASTOPEN_QUEUE = 256
+# not exported by the socket module, the value is from linux/tcp.h
+TCP_FASTOPEN_CONNECT = getattr( socket, 'TCP_FASTOPEN_CONNECT', 30 )
+
+# largest datagram relayed, datagrams read per wakeup and default flow idle time
+UDP_MAX = 65535
+UDP_BATCH = 64
+UDP_IDLE = 30.0
+
+# bytes each bench client writes at a time in the bulk test
+BENCH_CHUNK = 1 << 16
+# first byte of a bench connection whose data is discarded rather than echoed
+BENCH_SINK = b'S'
+# seconds to wait for the forwarder under test to start listening
+BENCH_START = 5.0
+
+# first twelve bytes of every PROXY protocol v2 header
+PROXY_V2_SIGNATURE = b'\r\n\r\n\x00\r\nQUIT\n'
+
+# smallest token bucket burst, in bytes
+MIN_BURST = 1024
+
+# upstream connect latency histogram buckets, in seconds
+LATENCY_BUCKETS = ( .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10 )
+
+# getaddrinfo() blocks, so lookups run here instead of on the accept path
+RESOLVER_THREADS = ThreadPoolExecutor( max_workers = 4, thread_name_prefix = 'resolver' )
+
+# splice(2) moves data socket -> pipe -> socket without leaving the kernel
+SPLICE = hasattr( os, 'splice' )
+SPLICE_FLAGS = getattr( os, 'SPLICE_F_MOVE', 0 )
+
+
+def splice_unsupported( e ):
+    """true if a splice error means the fds can't be spliced at all"""
+    return e.errno in ( errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP )
+
+
+def family_of( addr ):
+    """the address family of a socket address from getaddrinfo(), or a unix path"""
+    if isinstance( addr, str ):
+        return socket.AF_UNIX
+    return socket.AF_INET6 if len( addr ) == 4 else socket.AF_INET
+
+
+def peer( address ):
+    """( host, port ) of a client, for logs, limits and balancing"""
+    if not isinstance( address, tuple ):
+        # unix socket clients are anonymous
+        return ( 'unix', 0 )
+    host = address[0]
+    # ipv4 clients of a dual-stack listener show up as ::ffff:a.b.c.d
+    if host.startswith( '::ffff:' ) and '.' in host:
+        return ( host[7:], address[1] )
+    return address
+
+
+def tune( sock, spec, buffers = True ):
+    """apply --client-tcp or --backend-tcp options to a socket"""
+    tcp = sock.family != socket.AF_UNIX
+    if tcp and 'nodelay' in spec:
+        sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+    if tcp and 'quickack' in spec:
+        sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1 )
+    if tcp and 'keepalive' in spec:
+        sock.setsockopt( socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1 )
+        keepalive = ( socket.TCP_KEEPIDLE, socket.TCP_KEEPINTVL, socket.TCP_KEEPCNT )
+        for opt, value in zip( keepalive, spec['keepalive'] ):
+            sock.setsockopt( socket.IPPROTO_TCP, opt, value )
+    # buffer sizes have to be set before connect/listen to affect window scaling
+    if buffers and 'rcvbuf' in spec:
+        sock.setsockopt( socket.SOL_SOCKET, socket.SO_RCVBUF, spec['rcvbuf'] )
+    if buffers and 'sndbuf' in spec:
+        sock.setsockopt( socket.SOL_SOCKET, socket.SO_SNDBUF, spec['sndbuf'] )
+
+
+def bind_address( listen, kind ):
+    """( family, sockaddr ) to bind for a listen port, addr:port or unix path"""
+    if isinstance( listen, str ) and '/' in listen:
+        return socket.AF_UNIX, listen
+    if isinstance( listen, int ):
+        if socket.has_ipv6:
+            try:
+                socket.socket( socket.AF_INET6, kind ).close()
+                return socket.AF_INET6, ( '::', listen )
+            except OSError:
+                # built with ipv6 but the host has it turned off
+                pass
+        return socket.AF_INET, ( '', listen )
+    host, port = parse_target( listen, None )
+    family, _, _, _, addr = socket.getaddrinfo( host, port, socket.AF_UNSPEC, kind, 0,
+        socket.AI_PASSIVE )[0]
+    return family, addr
+
+
+def remove_stale_socket( path, kind = socket.SOCK_STREAM ):
+    """unlink a unix socket left at path by a process that's gone
+
+    anything else at path, or a socket someone still listens on, is an
+    error, like an address in use is for tcp"""
+    try:
+        mode = os.lstat( path ).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK( mode ):
+        raise OSError( errno.EEXIST, '%s, not a socket' % os.strerror( errno.EEXIST ), path )
+    probe = socket.socket( socket.AF_UNIX, kind )
+    try:
+        probe.connect( path )
+    except ConnectionRefusedError:
+        os.unlink( path )
+        return
+    finally:
+        probe.close()
+    raise OSError( errno.EADDRINUSE, os.strerror( errno.EADDRINUSE ), path )
+
+
+def listen_socket( listen, opts ):
+    kind = socket.SOCK_DGRAM if opts.udp else socket.SOCK_STREAM
+    family, addr = bind_address( listen, kind )
+    sock = socket.socket( family, kind )
+    if family == socket.AF_INET6 and addr[0] == '::':
+        # dual-stack, ipv4 clients arrive as ::ffff:a.b.c.d
+        sock.setsockopt( socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0 )
+    if family == socket.AF_UNIX:
+        # left behind by a previous run
+        remove_stale_socket( addr, kind )
+    if opts.workers:
+        # every worker binds the same port, the kernel balances between them
+        sock.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEPORT, 1 )
+    if opts.udp:
+        sock.bind( addr )
+        return sock
+    if family != socket.AF_UNIX:
+        # a restart can bind while old sessions are still in TIME_WAIT
+        sock.setsockopt( socket.SOL_SOCKET, socket.SO_REUSEADDR, 1 )
+    # accepted sockets inherit the buffer sizes
+    tune( sock, opts.client_tcp )
+    if family != socket.AF_UNIX and 'fastopen' in opts.client_tcp:
+        sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_FASTOPEN, opts.client_tcp['fastopen'] )
+    sock.bind( addr )
+    sock.listen( opts.backlog )
+    return sock
+
+
+def open_upstream( addr, opts = None, timeout = None ):
+    """a blocking socket connected to addr, with --backend-tcp applied if opts are given"""
+    sock = socket.socket( family_of( addr ), socket.SOCK_STREAM )
+    try:
+        if opts:
+            tune_upstream( sock, opts )
+        if timeout:
+            sock.settimeout( timeout )
+        sock.connect( addr )
+    except OSError:
+        sock.close()
+        raise
+    sock.settimeout( None )
+    return sock
+
+
+async def open_upstream_async( addr, opts = None ):
+    """a non-blocking socket connected to addr on the event loop"""
+    sock = socket.socket( family_of( addr ), socket.SOCK_STREAM )
+    sock.setblocking( False )
+    try:
+        if opts:
+            tune_upstream( sock, opts )
+        await asyncio.get_running_loop().sock_connect( sock, addr )
+    except BaseException:
+        # including being cancelled by a health check timeout
+        sock.close()
+        raise
+    return sock
+
+
+def tune_upstream( sock, opts ):
+    tune( sock, opts.backend_tcp )
+    if sock.family != socket.AF_UNIX and 'fastopen' in opts.backend_tcp:
+        # connect() returns at once and the SYN carries the first write
+        sock.setsockopt( socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1 )
+
+
+def proxy_header( version, client ):
+    """a PROXY protocol header telling the backend where client connected from, and to"""
+    if client.family == socket.AF_UNIX:
+        if version == 1:
+            return b'PROXY UNKNOWN\r\n'
+        # the PROXY command with an unspecified family and no addresses
+        return PROXY_V2_SIGNATURE + struct.pack( '!BBH', 0x21, 0x00, 0 )
+    src, dst = peer( client.getpeername() ), peer( client.getsockname() )
+    # neither format has room for a scope id
+    shost, dhost = src[0].split( '%' )[0], dst[0].split( '%' )[0]
+    v6 = ':' in shost
+    if version == 1:
+        return ( 'PROXY %s %s %s %s %s\r\n' % ( 'TCP6' if v6 else 'TCP4',
+            shost, dhost, src[1], dst[1] )).encode()
+    family = socket.AF_INET6 if v6 else socket.AF_INET
+    addrs = ( socket.inet_pton( family, shost ) + socket.inet_pton( family, dhost )
+        + struct.pack( '!HH', src[1], dst[1] ))
+    # version 2 PROXY command, then TCP over IPv6 or IPv4
+    return PROXY_V2_SIGNATURE + struct.pack( '!BBH', 0x21, 0x21 if v6 else 0x11, len( addrs )) + addrs
+
+
+def alive( sock ):
+    """an idle upstream is dead once the backend has closed or reset it"""
+    try:
+        # a server that talks first leaves its banner queued, that's fine
+        return sock.recv( 1, socket.MSG_PEEK | socket.MSG_DONTWAIT ) != b''
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+
+
+class Resolver( object ):
+    """caches the address of host and refreshes it in the background"""
+    def __init__( self, host, port, ttl ):
+        self.host = host
+        self.port = port
+        self.ttl = ttl
+        self.addr = None
+        self.expires = 0
+        self.refreshing = False
+        self.lock = threading.Lock()
+        self.pending = None
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    def __str__( self ):
+        if self.port is None:
+            return self.host
+        return ( '[%s]:%s' if ':' in self.host else '%s:%s' ) % ( self.host, self.port )
+
+    def lookup( self ):
+        if self.port is None:
+            # a unix socket path
+            return self.host
+        return socket.getaddrinfo( self.host, self.port, socket.AF_UNSPEC,
+            socket.SOCK_STREAM )[0][4]
+
+    def update( self, addr ):
+        self.addr = addr
+        self.expires = time.monotonic() + self.ttl
+
+    def refresh( self ):
+        try:
+            self.update( self.lookup() )
+        except OSError as e:
+            # keep serving the last known address and try again next ttl
+            self.failures += 1
+            self.expires = time.monotonic() + self.ttl
+            log( 'Resolving %s failed, keeping %s: %s', self.host, self.addr, e, level = WARNING )
+        finally:
+            self.refreshing = False
+
+    def cached( self ):
+        """the cached address, kicking off a refresh when it has expired"""
+        if self.addr is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if time.monotonic() >= self.expires:
+            with self.lock:
+                if self.refreshing: return self.addr
+                self.refreshing = True
+            RESOLVER_THREADS.submit( self.refresh )
+        return self.addr
+
+    def resolve( self ):
+        """blocking resolve, only looks up the host on a cold cache"""
+        addr = self.cached()
+        if addr is None:
+            addr = self.lookup()
+            self.update( addr )
+        return addr
+
+    async def resolve_async( self ):
+        addr = self.cached()
+        if addr is None:
+            # sessions arriving on a cold cache share one lookup
+            if self.pending is None:
+                loop = asyncio.get_running_loop()
+                self.pending = loop.run_in_executor( RESOLVER_THREADS, self.lookup )
+            try:
+                addr = await asyncio.shield( self.pending )
+            finally:
+                self.pending = None
+            self.update( addr )
+        return addr
+
+    def stats( self ):
+        lookups = self.hits + self.misses
+        return {
+            'dns_hits': self.hits,
+            'dns_misses': self.misses,
+            'dns_failures': self.failures,
+            'dns_hit_rate': '%.3f' % ( self.hits / lookups if lookups else 0 ),
+        }
+
+
+class UpstreamPool( object ):
+    """idle pre-connected upstream sockets, topped up to opts.pool"""
+    def __init__( self, resolver, opts ):
+        self.resolver = resolver
+        self.opts = opts
+        self.idle = collections.deque()
+        self.lock = threading.Lock()
+        self.refill = None
+        self.closed = False
+
+    def get( self ):
+        """pop a healthy idle socket, or None if the pool is empty"""
+        sock = None
+        with self.lock:
+            while self.idle:
+                s, since = self.idle.popleft()
+                if time.monotonic() - since < self.opts.pool_idle and alive( s ):
+                    sock = s
+                    break
+                s.close()
+        if self.refill is not None:
+            self.refill.set()
+        return sock
+
+    def put( self, sock ):
+        with self.lock:
+            if self.closed:
+                sock.close()
+                return
+            self.idle.append(( sock, time.monotonic() ))
 
-#enable logging to file
-#sys.stdout = open( 'pinhole.log', 'w' )
+    def close( self ):
+        """stop topping up and close the idle connections"""
+        with self.lock:
+            self.closed = True
+            for s, since in self.idle:
+                s.close()
+            self.idle.clear()
+        if self.refill is not None:
+            self.refill.set()
 
+    def evict( self ):
+        """close idle sockets that timed out or were closed by the backend"""
+        now = time.monotonic()
+        with self.lock:
+            keep = collections.deque()
+            for s, since in self.idle:
+                if now - since < self.opts.pool_idle and alive( s ):
+                    keep.append(( s, since ))
+                else:
+                    s.close()
+            self.idle = keep
 
-def log( s ):
-    print '%s:%s' % ( time.ctime(), s )
-    sys.stdout.flush()
+    def wanted( self ):
+        return 0 if self.closed else self.opts.pool - len( self.idle )
+
+    def run( self ):
+        """keep the pool topped up from a background thread"""
+        self.refill = threading.Event()
+        while not self.closed:
+            self.evict()
+            while self.wanted() > 0:
+                try:
+                    sock = open_upstream( self.resolver.resolve(), self.opts )
+                except OSError as e:
+                    log( 'Pool connect to %s failed: %s', self.resolver, e, level = WARNING )
+                    break
+                self.put( sock )
+            self.refill.wait( POOL_CHECK )
+            self.refill.clear()
+
+    async def run_async( self ):
+        """keep the pool topped up from the event loop"""
+        self.refill = asyncio.Event()
+        while not self.closed:
+            self.evict()
+            while self.wanted() > 0:
+                try:
+                    sock = await open_upstream_async( await self.resolver.resolve_async(), self.opts )
+                except OSError as e:
+                    log( 'Pool connect to %s failed: %s', self.resolver, e, level = WARNING )
+                    break
+                self.put( sock )
+            try:
+                await asyncio.wait_for( self.refill.wait(), POOL_CHECK )
+            except asyncio.TimeoutError:
+                pass
+            self.refill.clear()
+
+
+class Backend( object ):
+    """an upstream target with its own resolver, pool and health state"""
+    def __init__( self, host, port, opts ):
+        self.opts = opts
+        self.resolver = Resolver( host, port, opts.dns_ttl )
+        self.pool = None
+        if opts.pool:
+            self.pool = UpstreamPool( self.resolver, opts )
+        self.lock = threading.Lock()
+        self.active = 0
+        self.healthy = True
+        self.fails = 0
+        self.rises = 0
+
+    def __str__( self ):
+        return str( self.resolver )
+
+    def acquire( self ):
+        with self.lock:
+            self.active += 1
+
+    def release( self ):
+        with self.lock:
+            self.active -= 1
+
+    def close( self ):
+        if self.pool:
+            self.pool.close()
+
+    def connect( self, header = None ):
+        """a connected blocking upstream socket, from the pool if possible
+
+        header, eg. a PROXY protocol one, is sent before anything else"""
+        sock = self.pool and self.pool.get()
+        if sock:
+            sock.setblocking( True )
+        else:
+            sock = open_upstream( self.resolver.resolve(), self.opts )
+        if header:
+            try:
+                sock.sendall( header )
+            except OSError:
+                sock.close()
+                raise
+        return sock
+
+    async def connect_async( self, header = None ):
+        """a connected non-blocking upstream socket, from the pool if possible"""
+        sock = self.pool and self.pool.get()
+        if not sock:
+            sock = await open_upstream_async( await self.resolver.resolve_async(), self.opts )
+        if header:
+            try:
+                await asyncio.get_running_loop().sock_sendall( sock, header )
+            except OSError:
+                sock.close()
+                raise
+        return sock
+
+    def checked( self, ok ):
+        """record a health probe, ejecting or restoring the backend"""
+        if ok:
+            self.fails = 0
+            self.rises += 1
+            if not self.healthy and self.rises >= HEALTH_RISE:
+                self.healthy = True
+                log( 'Backend %s is healthy again', self )
+        else:
+            self.rises = 0
+            self.fails += 1
+            if self.healthy and self.fails >= HEALTH_FALL:
+                self.healthy = False
+                log( 'Backend %s failed %s health checks, ejecting', self, self.fails, level = WARNING )
+
+    def check( self ):
+        # untuned, a fast open connect would pass without a handshake
+        try:
+            open_upstream( self.resolver.resolve(), timeout = HEALTH_TIMEOUT ).close()
+        except OSError:
+            self.checked( False )
+        else:
+            self.checked( True )
+
+    async def check_async( self ):
+        try:
+            addr = await self.resolver.resolve_async()
+            sock = await asyncio.wait_for( open_upstream_async( addr ), HEALTH_TIMEOUT )
+        except ( OSError, asyncio.TimeoutError ):
+            self.checked( False )
+        else:
+            sock.close()
+            self.checked( True )
+
+    def stats( self ):
+        stats = { 'backend': str( self ), 'healthy': int( self.healthy ), 'active': self.active }
+        stats.update( self.resolver.stats() )
+        if self.pool:
+            stats['pool_idle'] = len( self.pool.idle )
+        return stats
+
+
+def ring_hash( s ):
+    return zlib.crc32( s.encode() )
+
+
+class Balancer( object ):
+    """picks the backend for each new session"""
+    policies = ( 'roundrobin', 'leastconn', 'hash' )
+
+    def __init__( self, backends, policy ):
+        self.backends = backends
+        self.policy = policy
+        self.turn = 0
+        ring = sorted(( ring_hash( '%s#%s' % ( b, i )), n )
+            for n, b in enumerate( backends ) for i in range( HASH_REPLICAS ))
+        self.ring_keys = [ k for k, n in ring ]
+        self.ring = [ backends[n] for k, n in ring ]
+
+    def pick( self, client ):
+        if len( self.backends ) == 1:
+            return self.backends[0]
+        if self.policy == 'hash':
+            # walk clockwise from the client's point to the first healthy backend
+            start = bisect.bisect( self.ring_keys, ring_hash( client ))
+            for i in range( len( self.ring )):
+                b = self.ring[( start + i ) % len( self.ring )]
+                if b.healthy:
+                    return b
+            return self.ring[ start % len( self.ring )]
+        # if every backend is ejected try them all rather than refuse
+        up = [ b for b in self.backends if b.healthy ] or self.backends
+        if self.policy == 'leastconn':
+            return min( up, key = lambda b: b.active )
+        self.turn += 1
+        return up[ self.turn % len( up )]
+
+
+class Histogram( object ):
+    """cumulative histogram in the shape prometheus expects"""
+    def __init__( self, buckets = LATENCY_BUCKETS ):
+        self.buckets = buckets
+        self.counts = [ 0 ] * len( buckets )
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe( self, value ):
+        i = bisect.bisect_left( self.buckets, value )
+        with self.lock:
+            if i < len( self.buckets ):
+                self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples( self, name, labels ):
+        total = 0
+        for le, n in zip( self.buckets, self.counts ):
+            total += n
+            yield name + '_bucket', dict( labels, le = le ), total
+        yield name + '_bucket', dict( labels, le = '+Inf' ), self.count
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, self.count
+
+    def absorb( self, other ):
+        with self.lock:
+            self.counts = [ a + b for a, b in zip( self.counts, other.counts ) ]
+            self.sum += other.sum
+            self.count += other.count
+
+
+class TokenBucket( object ):
+    """allows rate bytes per second on average, in bursts of up to burst"""
+    def __init__( self, rate, burst = None ):
+        self.rate = rate
+        self.burst = burst or max( rate, MIN_BURST )
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take( self, n ):
+        """spend n bytes, returns how many seconds to wait before sending them"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min( self.burst, self.tokens + ( now - self.stamp ) * self.rate )
+            self.stamp = now
+            # go into debt rather than split the chunk, later callers wait it off
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def available( self ):
+        """tokens right now, negative while callers are waiting off a debt"""
+        return min( self.burst, self.tokens + ( time.monotonic() - self.stamp ) * self.rate )
+
+
+class Budget( object ):
+    """caps the bytes held in relay buffers across every session
+
+    buffers are lent only while a pipe has data to move and room to
+    send it, and kept for reuse afterwards while the spares fit in the
+    budget as well"""
+    def __init__( self, limit ):
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self.paused = 0.0
+        # waiter -> when it started waiting, for the waits still going on
+        self.pausing = {}
+        # size -> spare buffers
+        self.spares = collections.defaultdict( list )
+        self.spare = 0
+        self.lock = threading.Lock()
+        # thread engine pipes wait on this for a buffer to come back
+        self.returned = threading.Condition( self.lock )
+        # and async pipes on these futures, from any event loop
+        self.waiters = collections.deque()
+
+    def fits( self, size ):
+        # one buffer always goes out, so a budget under one chunk can't stall everything
+        return not self.used or self.used + size <= self.limit
+
+    def lend( self, size ):
+        """account for a buffer of size bytes, a spare one or None, call with the lock held"""
+        self.used += size
+        self.peak = max( self.peak, self.used )
+        spares = self.spares[ size ]
+        if spares:
+            self.spare -= size
+            return spares.pop()
+        return None
+
+    def take( self, size, waiter ):
+        """a buffer of size bytes, blocking until the budget has room"""
+        with self.lock:
+            if not self.fits( size ):
+                self.pausing[ waiter ] = time.monotonic()
+                try:
+                    while not self.fits( size ):
+                        self.returned.wait()
+                finally:
+                    self.paused += time.monotonic() - self.pausing.pop( waiter )
+            buf = self.lend( size )
+        return buf or memoryview( bytearray( size ))
+
+    async def take_async( self, size, waiter ):
+        """take() for the event loop"""
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            if self.fits( size ):
+                buf = self.lend( size )
+                return buf or memoryview( bytearray( size ))
+            self.pausing[ waiter ] = time.monotonic()
+        try:
+            while True:
+                fut = loop.create_future()
+                with self.lock:
+                    if self.fits( size ):
+                        buf = self.lend( size )
+                        break
+                    self.waiters.append( fut )
+                try:
+                    await fut
+                except asyncio.CancelledError:
+                    with self.lock:
+                        if fut in self.waiters:
+                            self.waiters.remove( fut )
+                        else:
+                            # give() picked us, pass its wakeup on
+                            self.wake()
+                    raise
+        finally:
+            with self.lock:
+                self.paused += time.monotonic() - self.pausing.pop( waiter )
+        return buf or memoryview( bytearray( size ))
+
+    def give( self, buf ):
+        size = len( buf )
+        with self.lock:
+            self.used -= size
+            if self.used + self.spare + size <= self.limit:
+                self.spares[ size ].append( buf )
+                self.spare += size
+            self.wake()
+
+    def wake( self ):
+        """let a waiting pipe of each engine try again, call with the lock held"""
+        self.returned.notify()
+        if self.waiters:
+            fut = self.waiters.popleft()
+            fut.get_loop().call_soon_threadsafe( lambda: fut.done() or fut.set_result( None ))
+
+    def paused_total( self ):
+        """seconds spent waiting for buffers, counting the waits not over yet"""
+        now = time.monotonic()
+        with self.lock:
+            return self.paused + sum( now - started for started in self.pausing.values() )
+
+    def stats( self ):
+        return { 'buffered': self.used, 'buffered_peak': self.peak,
+            'budget_paused': round( self.paused_total(), 3 ) }
+
+
+def watermarks( opts ):
+    """the --high-water and --low-water marks in bytes"""
+    high = int( opts.high_water )
+    low = int( opts.low_water ) if opts.low_water is not None else high // 2
+    return high, low
+
+
+class Shaper( object ):
+    """the process wide and per client address token buckets, and the memory budget"""
+    def __init__( self, opts ):
+        self.opts = opts
+        self.all = TokenBucket( opts.rate_global ) if opts.rate_global else None
+        self.budget = Budget( opts.memory_budget ) if opts.memory_budget else None
+        # ip -> [ bucket, sessions using it ]
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def active( self, opts ):
+        return bool( opts.rate_session or self.opts.rate_client or self.all )
+
+    def acquire( self, ip, opts ):
+        """the buckets a new session from ip, on a listener with opts, draws on"""
+        buckets = []
+        if opts.rate_session:
+            buckets.append( TokenBucket( opts.rate_session ))
+        if self.opts.rate_client:
+            with self.lock:
+                entry = self.clients.setdefault( ip, [ TokenBucket( self.opts.rate_client ), 0 ] )
+                entry[1] += 1
+            buckets.append( entry[0] )
+        if self.all:
+            buckets.append( self.all )
+        return buckets
+
+    def release( self, ip ):
+        if not self.opts.rate_client: return
+        with self.lock:
+            entry = self.clients[ ip ]
+            entry[1] -= 1
+            if not entry[1]:
+                del self.clients[ ip ]
+
+    def stats( self ):
+        stats = { 'shaped_clients': len( self.clients ) }
+        if self.all:
+            stats['global_tokens'] = int( self.all.available() )
+        return stats
+
+
+class Admission( object ):
+    """the process wide session limits, connections over them are queued or refused"""
+    def __init__( self, opts ):
+        self.opts = opts
+        self.limited = bool( opts.max_sessions or opts.max_client_sessions
+            or opts.client_conn_rate )
+        self.active = 0
+        # ip -> [ open sessions, new connection bucket or None ]
+        self.clients = {}
+        # ( deadline, ip, start, refuse ) for queued connections, oldest first
+        self.waiting = collections.deque()
+        self.queued = 0
+        self.swept = time.monotonic()
+        self.ticking = False
+        self.lock = threading.Lock()
+
+    def blocked( self, ip ):
+        """the limit a new session from ip is over, None if it may start"""
+        if self.opts.max_sessions and self.active >= self.opts.max_sessions:
+            return 'max_sessions'
+        entry = self.clients.get( ip )
+        if not entry:
+            return None
+        if self.opts.max_client_sessions and entry[0] >= self.opts.max_client_sessions:
+            return 'client_sessions'
+        if entry[1] and entry[1].available() < 1:
+            return 'client_rate'
+        return None
+
+    def take( self, ip ):
+        entry = self.clients.get( ip )
+        if not entry:
+            rate = self.opts.client_conn_rate
+            entry = self.clients[ ip ] = [ 0, TokenBucket( rate, max( rate, 1 )) if rate else None ]
+        entry[0] += 1
+        if entry[1]:
+            entry[1].take( 1 )
+        self.active += 1
+
+    def sweep( self ):
+        """forget addresses with nothing open and a full bucket, call with the lock held"""
+        now = time.monotonic()
+        if now - self.swept < ADMISSION_SWEEP: return
+        self.swept = now
+        for ip, ( n, bucket ) in list( self.clients.items() ):
+            if not n and ( not bucket or bucket.available() >= bucket.burst ):
+                del self.clients[ ip ]
+
+    def admit( self, ip, start, refuse ):
+        """call start() when a session from ip may begin, or refuse( limit ) if it can't
+
+        either may be called later from another thread if the connection is queued"""
+        if not self.limited:
+            start()
+            return
+        with self.lock:
+            self.sweep()
+            limit = self.blocked( ip )
+            if limit is None:
+                self.take( ip )
+            elif self.opts.overflow == 'queue':
+                if len( self.waiting ) < ADMISSION_QUEUE:
+                    self.waiting.append(( time.monotonic() + self.opts.queue_timeout,
+                        ip, start, refuse ))
+                    self.queued += 1
+                    if not self.ticking:
+                        self.ticking = True
+                        Thread( target = self.tick, daemon = True ).start()
+                    return
+                limit = 'queue_full'
+        if limit is None:
+            start()
+        else:
+            refuse( limit )
+
+    def release( self, ip ):
+        """a session admitted for ip has finished"""
+        if not self.limited: return
+        with self.lock:
+            self.active -= 1
+            entry = self.clients[ ip ]
+            entry[0] -= 1
+            if not entry[0] and not entry[1]:
+                del self.clients[ ip ]
+        self.pump()
+
+    def pump( self ):
+        """start queued connections that now fit, refuse those past their deadline"""
+        if not self.waiting: return
+        ready, expired = [], []
+        now = time.monotonic()
+        with self.lock:
+            waiting = collections.deque()
+            for w in self.waiting:
+                deadline, ip, start, refuse = w
+                if self.blocked( ip ) is None:
+                    self.take( ip )
+                    ready.append( start )
+                elif now > deadline:
+                    expired.append( refuse )
+                else:
+                    waiting.append( w )
+            self.waiting = waiting
+        for start in ready:
+            start()
+        for refuse in expired:
+            refuse( 'queue_timeout' )
+
+    def tick( self ):
+        # per client rates refill and deadlines pass without any session ending
+        while True:
+            time.sleep( ADMISSION_CHECK )
+            self.pump()
+            with self.lock:
+                # the next connection to queue starts another ticker
+                if not self.waiting:
+                    self.ticking = False
+                    return
+
+    def stats( self ):
+        return { 'admitted_sessions': self.active, 'waiting': len( self.waiting ),
+            'queued': self.queued }
+
+
+def ip_checksum( header ):
+    total = sum( struct.unpack( '!%dH' % ( len( header ) // 2 ), header ))
+    while total >> 16:
+        total = ( total & 0xffff ) + ( total >> 16 )
+    return ~total & 0xffff
+
+
+class Capture( object ):
+    """tees session data to per session files, or one pcapng file, from a writer thread"""
+    def __init__( self, path, limit ):
+        self.path = path
+        self.limit = limit
+        self.pcapng = path.endswith( '.pcapng' )
+        self.queue = queue.SimpleQueue()
+        # data records queued, open and end records are never dropped
+        self.pending = 0
+        self.written = 0
+        self.dropped = 0
+        self.failing = False
+        self.lock = threading.Lock()
+        # id -> { 'name' or 'ends', 'seen', 'ended' } for sessions being recorded
+        self.streams = {}
+        # ( id, direction ) -> open per session file
+        self.files = {}
+        self.out = None
+        if self.pcapng:
+            self.start_pcapng()
+        else:
+            os.makedirs( path, exist_ok = True )
+        self.writer = Thread( target = self.run, daemon = True )
+        self.writer.start()
+        # write out what's queued on a normal exit
+        atexit.register( self.stop )
+
+    def open( self, session ):
+        try:
+            local = peer( session.client.getsockname() )
+        except OSError:
+            local = ( 'unix', 0 )
+        self.queue.put(( 'open', session.id, None, time.time(), 0, ( session.address, local )))
+
+    def data( self, id, direction, offset, data ):
+        """queue a copy of data, or drop it if the writer is CAPTURE_QUEUE behind"""
+        with self.lock:
+            if self.pending >= CAPTURE_QUEUE:
+                self.dropped += 1
+                return
+            self.pending += 1
+        self.queue.put(( 'data', id, direction, time.time(), offset, bytes( data )))
+
+    def end( self, id, direction, offset, clean ):
+        self.queue.put(( 'end', id, direction, time.time(), offset, clean ))
+
+    def stop( self ):
+        self.queue.put( None )
+        self.writer.join()
+
+    def run( self ):
+        while True:
+            record = self.queue.get()
+            if record is None: break
+            kind = record[0]
+            if kind == 'data':
+                with self.lock:
+                    self.pending -= 1
+            try:
+                if self.pcapng:
+                    self.write_pcapng( *record )
+                else:
+                    self.write_file( *record )
+                if self.out and self.queue.empty():
+                    self.out.flush()
+            except OSError as e:
+                if kind == 'data':
+                    with self.lock:
+                        self.dropped += 1
+                if not self.failing:
+                    log( 'Capture to %s failed: %s', self.path, e, level = WARNING )
+                self.failing = True
+                continue
+            self.failing = False
+            if kind == 'data':
+                self.written += 1
+        for f in self.files.values():
+            f.close()
+        if self.out:
+            self.out.close()
+
+    def write_file( self, kind, id, direction, stamp, offset, data ):
+        if kind == 'open':
+            client = data[0]
+            name = os.path.join( self.path, '%s-%s-%s' % ( id, client[0], client[1] ))
+            self.streams[ id ] = { 'name': name, 'ended': 0 }
+            return
+        stream = self.streams.get( id )
+        if not stream: return
+        key = id, direction
+        name = stream['name'] + ( '.in', '.out' )[ direction ]
+        if kind == 'end':
+            f = self.files.pop( key, None )
+            if f:
+                f.close()
+            self.ended( id )
+            return
+        f = self.files.get( key )
+        if not f:
+            f = self.files[ key ] = open( name, 'wb', buffering = 0 )
+        f.write( data )
+        if f.tell() > self.limit:
+            f.close()
+            os.replace( name, name + '.1' )
+            self.files[ key ] = open( name, 'wb', buffering = 0 )
+
+    def ended( self, id ):
+        stream = self.streams[ id ]
+        stream['ended'] += 1
+        if stream['ended'] == 2:
+            del self.streams[ id ]
+
+    def start_pcapng( self ):
+        self.out = open( self.path, 'wb' )
+        # section header: byte order magic, version 1.0, unknown section length
+        self.block( PCAPNG_SECTION, struct.pack( '<IHHq', 0x1A2B3C4D, 1, 0, -1 ))
+        # one interface, no snap length
+        self.block( PCAPNG_INTERFACE, struct.pack( '<HHI', LINKTYPE_RAW, 0, 0 ))
+
+    def block( self, kind, body ):
+        body += b'\0' * ( -len( body ) % 4 )
+        size = struct.pack( '<I', len( body ) + 12 )
+        self.out.write( struct.pack( '<I', kind ) + size + body + size )
+
+    def packet( self, stamp, src, dst, seq, ack, flags, payload = b'' ):
+        tcp = struct.pack( '!HHIIBBHHH', src[1], dst[1], seq & 0xffffffff, ack & 0xffffffff,
+            5 << 4, flags, 0xffff, 0, 0 ) + payload
+        if ':' in src[0]:
+            ip = ( struct.pack( '!IHBB', 6 << 28, len( tcp ), 6, 64 )
+                + socket.inet_pton( socket.AF_INET6, src[0] )
+                + socket.inet_pton( socket.AF_INET6, dst[0] ))
+        else:
+            ip = ( struct.pack( '!BBHHHBBH', 0x45, 0, 20 + len( tcp ), 0, 0x4000, 64, 6, 0 )
+                + socket.inet_aton( src[0] ) + socket.inet_aton( dst[0] ))
+            ip = ip[:10] + struct.pack( '!H', ip_checksum( ip )) + ip[12:]
+        micros = int( stamp * 1e6 )
+        self.block( PCAPNG_PACKET, struct.pack( '<IIIII', 0, micros >> 32, micros & 0xffffffff,
+            len( ip ) + len( tcp ), len( ip ) + len( tcp )) + ip + tcp )
+
+    def write_pcapng( self, kind, id, direction, stamp, offset, data ):
+        if kind == 'open':
+            client, local = [ ( a[0].split( '%' )[0], a[1] ) for a in data ]
+            if client[0] == 'unix':
+                # made up addresses, the session id keeps the streams apart
+                client, local = ( '127.0.0.1', id & 0xffff ), ( '127.0.0.1', 0 )
+            self.streams[ id ] = { 'ends': ( client, local ), 'seen': [ 0, 0 ], 'ended': 0 }
+            self.packet( stamp, client, local, 0, 0, TCP_SYN )
+            self.packet( stamp, local, client, 0, 1, TCP_SYN | TCP_ACK )
+            self.packet( stamp, client, local, 1, 1, TCP_ACK )
+            return
+        stream = self.streams.get( id )
+        if not stream: return
+        src, dst = stream['ends'] if direction == 0 else stream['ends'][::-1]
+        seen = stream['seen']
+        # sequence numbers count from the made up SYN, so data starts at 1
+        ack = seen[ 1 - direction ] + 1
+        if kind == 'end':
+            self.packet( stamp, src, dst, offset + 1, ack, TCP_FIN | TCP_ACK if data else TCP_RST )
+            self.ended( id )
+        else:
+            for i in range( 0, len( data ), CAPTURE_SEGMENT ):
+                self.packet( stamp, src, dst, offset + i + 1, ack, TCP_PSH | TCP_ACK,
+                    data[ i:i + CAPTURE_SEGMENT ] )
+            seen[ direction ] = max( seen[ direction ], offset + len( data ))
+        if self.out.tell() > self.limit:
+            self.out.close()
+            os.replace( self.path, self.path + '.1' )
+            self.start_pcapng()
+
+
+CAPTURE = None
+
+
+def start_capture( opts ):
+    """start the capture writer if --capture is set, call again after fork"""
+    global CAPTURE
+    CAPTURE = Capture( opts.capture, opts.capture_size ) if opts.capture else None
+
+
+class Session( object ):
+    """a client connection, its upstream and the pipes between them"""
+    ids = itertools.count( 1 )
+
+    def __init__( self, listener, client, upstream, address, backend, connect_time ):
+        self.id = next( Session.ids )
+        self.listener = listener
+        self.client = client
+        self.upstream = upstream
+        self.address = address
+        self.backend = backend
+        self.connect_time = connect_time
+        self.started = time.monotonic()
+        self.last_active = self.started
+        self.aborted = False
+        self.buckets = listener.shaper.acquire( address[0], listener.opts )
+        # never read more than the smallest bucket can pass in one burst
+        self.chunk = int( min( [ b.burst for b in self.buckets ] + [ listener.opts.bufsize ] ))
+        if listener.opts.high_water:
+            high, low = watermarks( listener.opts )
+            # a read on top of what the kernel holds back has to stay under the high mark
+            self.chunk = min( self.chunk, high - low )
+            for sock in ( client, upstream ):
+                if sock.family != socket.AF_UNIX:
+                    sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, low )
+        self.budget = listener.shaper.budget
+        self.throttled = 0.0
+        self.capture = CAPTURE
+        self.pipes = []
+        self.lock = threading.Lock()
+        self.open_pipes = 2
+
+    @property
+    def bytes_in( self ):
+        return self.pipes[0].sent if self.pipes else 0
+
+    @property
+    def bytes_out( self ):
+        return self.pipes[1].sent if len( self.pipes ) > 1 else 0
+
+    def tcp_options( self, sock ):
+        if sock.family == socket.AF_UNIX:
+            return {}
+        opts = self.listener.opts
+        return opts.client_tcp if sock is self.client else opts.backend_tcp
+
+    def shape( self, n ):
+        """charge n bytes to every bucket, returns seconds to wait before sending"""
+        wait = max( [ b.take( n ) for b in self.buckets ], default = 0 )
+        self.throttled += wait
+        return wait
+
+    def end_capture( self, pipe, clean ):
+        if self.capture:
+            self.capture.end( self.id, pipe.direction, pipe.sent, clean )
+
+    def abort( self ):
+        """shut both sockets down, which makes both pipes finish"""
+        self.aborted = True
+        for sock in ( self.client, self.upstream ):
+            try:
+                sock.shutdown( socket.SHUT_RDWR )
+            except OSError:
+                pass
+
+    def pipe_done( self ):
+        """called as each direction finishes, closes the session after both"""
+        with self.lock:
+            self.open_pipes -= 1
+            if self.open_pipes: return
+        self.client.close()
+        self.upstream.close()
+        self.listener.shaper.release( self.address[0] )
+        self.listener.admission.release( self.address[0] )
+        self.listener.close_session( self )
+
+
+class SessionTable( object ):
+    """live sessions by id, safe to use from any thread"""
+    def __init__( self ):
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def add( self, session ):
+        with self.lock:
+            self.sessions[ session.id ] = session
+
+    def remove( self, session ):
+        with self.lock:
+            self.sessions.pop( session.id, None )
+
+    def get( self, id ):
+        return self.sessions.get( id )
+
+    def __len__( self ):
+        return len( self.sessions )
+
+    def __iter__( self ):
+        # iterate a snapshot so sessions can come and go meanwhile
+        with self.lock:
+            return iter( list( self.sessions.values() ))
+
+
+def wait_writable( sock ):
+    """block until sock has room to send, or has failed"""
+    poller = select.poll()
+    poller.register( sock, select.POLLOUT )
+    poller.poll()
+
+
+def send_some( sock, data ):
+    """send what fits without blocking, returns how much that was"""
+    try:
+        return sock.send( data, socket.MSG_DONTWAIT )
+    except BlockingIOError:
+        return 0
+
+
+def half_close( sock ):
+    """pass an EOF on to the peer, the other direction keeps going"""
+    try:
+        sock.shutdown( socket.SHUT_WR )
+    except OSError:
+        pass
 
 
 class PipeThread( Thread ):
-    pipes = []
-    def __init__( self, source, sink ):
+    def __init__( self, session, source, sink, opts ):
         Thread.__init__( self )
+        self.session = session
         self.source = source
         self.sink = sink
+        self.opts = opts
+        self.sent = 0
+        self.quickack = 'quickack' in session.tcp_options( source )
+        # 0 for client to backend, 1 for the replies
+        self.direction = len( session.pipes )
+        session.pipes.append( self )
 
-        log( 'Creating new pipe thread  %s ( %s -> %s )' % \
-            ( self, source.getpeername(), sink.getpeername() ))
-        PipeThread.pipes.append( self )
-        log( '%s pipes active' % len( PipeThread.pipes ))
+        log( 'Creating new pipe thread %s for session %s', self, session.id, level = DEBUG )
 
     def run( self ):
+        try:
+            # captured data has to come up to userspace to be copied
+            if not ( self.opts.splice and not self.session.capture and self.relay_splice() ):
+                self.relay_copy()
+        except OSError as e:
+            self.session.listener.error( 'relay', e )
+            self.session.abort()
+            self.session.end_capture( self, False )
+        else:
+            half_close( self.sink )
+            self.session.end_capture( self, True )
+
+        log( '%s terminating', self, level = DEBUG )
+        self.session.pipe_done()
+
+    def relay_copy( self ):
+        budget = self.session.budget
+        # under a memory budget a buffer is only held while there is data to
+        # move and room to send it, so peers that don't read can't pin buffers
+        buf = None if budget else memoryview( bytearray( self.session.chunk ))
+        capture = self.session.capture
         while True:
+            tail = None
+            if budget:
+                wait_writable( self.sink )
+                if not self.source.recv( 1, socket.MSG_PEEK ): break
+                buf = budget.take( self.session.chunk, self )
             try:
-                data = self.source.recv( 1024 )
-                if not data: break
-                self.sink.send( data )
-            except:
-                break
+                n = self.source.recv_into( buf )
+                if not n: break
+                if self.quickack:
+                    # the kernel drops back to delayed acks, so re-arm after every read
+                    self.source.setsockopt( socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1 )
+                self.session.last_active = time.monotonic()
+                wait = self.session.shape( n )
+                if wait:
+                    time.sleep( wait )
+                if budget:
+                    sent = send_some( self.sink, buf[:n] )
+                    if sent < n:
+                        tail = bytes( buf[sent:n] )
+                else:
+                    self.sink.sendall( buf[:n] )
+                if capture:
+                    capture.data( self.session.id, self.direction, self.sent, buf[:n] )
+                self.sent += n
+            finally:
+                if budget:
+                    budget.give( buf )
+            # what a short send left over waits in a copy, the buffer is back in the budget
+            if tail:
+                self.sink.sendall( tail )
 
-        log( '%s terminating' % self )
-        PipeThread.pipes.remove( self )
-        log( '%s pipes active' % len( PipeThread.pipes ))
+    def relay_splice( self ):
+        """relay inside the kernel, returns False if these fds can't be spliced"""
+        src, dst = self.source.fileno(), self.sink.fileno()
+        rfd, wfd = os.pipe()
+        moved = False
+        try:
+            while True:
+                try:
+                    n = os.splice( src, wfd, self.session.chunk, flags = SPLICE_FLAGS )
+                except OSError as e:
+                    if not moved and splice_unsupported( e ):
+                        return False
+                    raise
+                if not n: return True
+                moved = True
+                if self.quickack:
+                    self.source.setsockopt( socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1 )
+                self.session.last_active = time.monotonic()
+                wait = self.session.shape( n )
+                if wait:
+                    time.sleep( wait )
+                while n:
+                    m = os.splice( rfd, dst, n, flags = SPLICE_FLAGS )
+                    self.sent += m
+                    n -= m
+        finally:
+            os.close( rfd )
+            os.close( wfd )
 
 
-class Pinhole( Thread ):
-    def __init__( self, port, newhost, newport ):
-        Thread.__init__( self )
-        log( 'Redirecting: localhost:%s -> %s:%s' % ( port, newhost, newport ))
-        self.newhost = newhost
-        self.newport = newport
-        self.sock = socket( AF_INET, SOCK_STREAM )
-        self.sock.bind(( '', port ))
-        self.sock.listen(5)
+class Listener( object ):
+    """state shared by the thread and async listeners"""
+    def __init__( self, port, targets, opts = None, shaper = None, admission = None, sock = None ):
+        self.port = port
+        self.targets = targets
+        self.opts = opts or default_opts()
+        self.shaper = shaper or Shaper( self.opts )
+        self.admission = admission or Admission( self.opts )
+        self.stopped = False
+        # replaced on reload, kept around until its last session closes
+        self.retired = False
+        # whether the health check and reaper loops are running
+        self.checking = False
+        self.reaping = False
+        self.backends = [ Backend( host, newport, self.opts ) for host, newport in targets ]
+        self.balancer = Balancer( self.backends, self.opts.balance )
+        self.sessions = SessionTable()
+        self.lock = threading.Lock()
+        self.accepted = 0
+        self.closed = 0
+        self.closed_bytes_in = 0
+        self.closed_bytes_out = 0
+        self.closed_throttled = 0.0
+        self.errors = collections.Counter()
+        self.connect_latency = Histogram()
+        log( 'Redirecting: localhost:%s -> %s', port, ', '.join( map( str, self.backends )))
+        # a socket handed over by the process we are replacing, or a new one
+        self.sock = sock or listen_socket( port, self.opts )
+
+    def error( self, stage, e ):
+        kind = e if isinstance( e, str ) else type( e ).__name__
+        with self.lock:
+            self.errors[ stage, kind ] += 1
+
+    def open_session( self, client, upstream, address, backend, connect_time ):
+        self.connect_latency.observe( connect_time )
+        session = Session( self, client, upstream, address, backend, connect_time )
+        if session.capture:
+            session.capture.open( session )
+        self.sessions.add( session )
+        log( 'Session %s opened for %s %s, %s sessions active',
+            session.id, address[0], address[1], len( self.sessions ),
+            sample = True, event = 'open', session = session.id, listen = self.port,
+            client = address[0], backend = backend, connect_seconds = connect_time )
+        return session
+
+    def close_session( self, session ):
+        self.sessions.remove( session )
+        session.backend.release()
+        with self.lock:
+            self.closed += 1
+            self.closed_bytes_in += session.bytes_in
+            self.closed_bytes_out += session.bytes_out
+            self.closed_throttled += session.throttled
+        duration = time.monotonic() - session.started
+        log( 'Session %s closed after %.1fs, %s bytes in, %s bytes out, %s sessions active',
+            session.id, duration, session.bytes_in, session.bytes_out, len( self.sessions ),
+            sample = True, event = 'close', session = session.id, listen = self.port,
+            seconds = duration, bytes_in = session.bytes_in, bytes_out = session.bytes_out )
+
+    def health_checks( self ):
+        return len( self.backends ) > 1 and self.opts.health_interval > 0
+
+    def reconfigure( self, targets, opts ):
+        """switch to new backends and options, open sessions keep their old backend"""
+        old = self.backends
+        self.targets = targets
+        self.opts = opts
+        self.backends = [ Backend( host, newport, opts ) for host, newport in targets ]
+        self.balancer = Balancer( self.backends, opts.balance )
+        for b in old:
+            b.close()
+        log( 'Redirecting: localhost:%s -> %s', self.port, ', '.join( map( str, self.backends )))
+        self.start_background()
+
+    def stop( self, shared = False ):
+        """stop accepting, sessions already open run until they finish
+
+        shared means another process now has the listening socket too,
+        so only our own fd may be closed"""
+        log( 'No longer listening on %s, %s sessions still open', self.port, len( self.sessions ))
+        self.stopped = True
+        for b in self.backends:
+            b.close()
+
+    def absorb( self, other ):
+        """take over the totals of a retired listener on the same port, so its counters don't go backwards"""
+        with self.lock:
+            self.accepted += other.accepted
+            self.closed += other.closed
+            self.closed_bytes_in += other.closed_bytes_in
+            self.closed_bytes_out += other.closed_bytes_out
+            self.closed_throttled += other.closed_throttled
+            self.errors.update( other.errors )
+        self.connect_latency.absorb( other.connect_latency )
+
+    def abort_sessions( self ):
+        for s in self.sessions:
+            s.abort()
+
+    def reaper_needed( self ):
+        # a stopped listener still times out the sessions it has left
+        return self.timeouts() and not ( self.stopped and not len( self.sessions ))
+
+    def admit( self, sock, address ):
+        """start a session for an accepted socket now, later or never, as admission allows"""
+        self.admission.admit( address[0], lambda: self.dispatch( sock, address ),
+            lambda limit: self.refuse( sock, address, limit ))
+
+    def refuse( self, sock, address, limit ):
+        log( 'Refused %s %s, over %s', address[0], address[1], limit, sample = True,
+            event = 'refuse', listen = self.port, client = address[0], limit = limit )
+        self.error( 'admission', limit )
+        # reset rather than close so a flood leaves nothing in TIME_WAIT
+        try:
+            sock.setsockopt( socket.SOL_SOCKET, socket.SO_LINGER, struct.pack( 'ii', 1, 0 ))
+        except OSError:
+            pass
+        sock.close()
+
+    def session_failed( self, sock, address ):
+        """give back what a session that never got going had taken"""
+        self.admission.release( address[0] )
+        sock.close()
+
+    def proxy_header( self, sock ):
+        if self.opts.proxy_protocol:
+            return proxy_header( self.opts.proxy_protocol, sock )
+
+    def tune_client( self, sock ):
+        """apply --client-tcp to an accepted socket"""
+        try:
+            tune( sock, self.opts.client_tcp, buffers = False )
+        except OSError as e:
+            self.error( 'tune', e )
+            return False
+        return True
+
+    def timeouts( self ):
+        return self.opts.idle_timeout > 0 or self.opts.session_timeout > 0
+
+    def reap( self ):
+        """abort sessions that were idle, or open, for too long"""
+        now = time.monotonic()
+        idle, limit = self.opts.idle_timeout, self.opts.session_timeout
+        for s in self.sessions:
+            if s.aborted:
+                continue
+            if idle and now - s.last_active > idle:
+                kind = 'idle'
+            elif limit and now - s.started > limit:
+                kind = 'session'
+            else:
+                continue
+            log( 'Session %s hit the %s timeout, closing', s.id, kind )
+            self.error( 'timeout', kind )
+            s.abort()
+
+    def throttled( self ):
+        return self.closed_throttled + sum( s.throttled for s in self.sessions )
+
+    def stats( self ):
+        stats = {
+            'listen': self.port,
+            'balance': self.opts.balance,
+            'sessions': len( self.sessions ),
+            'backends': [ b.stats() for b in self.backends ],
+        }
+        if self.retired:
+            stats['retired'] = 1
+        if self.shaper.active( self.opts ):
+            stats['throttled'] = round( self.throttled(), 3 )
+            stats.update( self.shaper.stats() )
+        if self.shaper.budget:
+            stats.update( self.shaper.budget.stats() )
+        if self.admission.limited:
+            stats['refused'] = sum( n for ( stage, _ ), n in list( self.errors.items() )
+                if stage == 'admission' )
+            stats.update( self.admission.stats() )
+        return stats
+
+    def metrics( self ):
+        """( name, labels, value ) samples for the metrics endpoint"""
+        labels = { 'listen': self.port }
+        live = list( self.sessions )
+        yield 'pinhole_accepted_total', labels, self.accepted
+        yield 'pinhole_sessions_active', labels, len( live )
+        yield 'pinhole_sessions_closed_total', labels, self.closed
+        yield 'pinhole_bytes_in_total', labels, \
+            self.closed_bytes_in + sum( s.bytes_in for s in live )
+        yield 'pinhole_bytes_out_total', labels, \
+            self.closed_bytes_out + sum( s.bytes_out for s in live )
+        for ( stage, kind ), n in list( self.errors.items() ):
+            yield 'pinhole_errors_total', dict( labels, stage = stage, type = kind ), n
+        yield from self.connect_latency.samples( 'pinhole_connect_seconds', labels )
+        if self.shaper.active( self.opts ):
+            yield 'pinhole_throttled_seconds_total', labels, round( self.throttled(), 3 )
+        now = time.monotonic()
+        for s in live:
+            sl = dict( labels, session = s.id, client = s.address[0], backend = str( s.backend ))
+            yield 'pinhole_session_bytes_in', sl, s.bytes_in
+            yield 'pinhole_session_bytes_out', sl, s.bytes_out
+            yield 'pinhole_session_age_seconds', sl, round( now - s.started, 3 )
+            yield 'pinhole_session_connect_seconds', sl, s.connect_time
+            if s.buckets:
+                yield 'pinhole_session_throttled_seconds', sl, round( s.throttled, 3 )
+        # the process wide numbers and backend health come from the listener that replaced us
+        if self.retired:
+            return
+        if self.shaper.active( self.opts ):
+            yield 'pinhole_shaped_clients', labels, len( self.shaper.clients )
+            if self.shaper.all:
+                yield 'pinhole_global_tokens', labels, int( self.shaper.all.available() )
+        budget = self.shaper.budget
+        if budget:
+            yield 'pinhole_memory_budget_bytes', labels, budget.limit
+            yield 'pinhole_buffered_bytes', labels, budget.used
+            yield 'pinhole_buffered_peak_bytes', labels, budget.peak
+            yield 'pinhole_budget_paused_seconds_total', labels, round( budget.paused_total(), 3 )
+        if CAPTURE:
+            yield 'pinhole_capture_written_total', labels, CAPTURE.written
+            yield 'pinhole_capture_dropped_total', labels, CAPTURE.dropped
+        if self.admission.limited:
+            yield 'pinhole_admitted_sessions', labels, self.admission.active
+            yield 'pinhole_admission_waiting', labels, len( self.admission.waiting )
+            yield 'pinhole_admission_queued_total', labels, self.admission.queued
+        for b in self.backends:
+            bl = dict( labels, backend = str( b ))
+            yield 'pinhole_backend_up', bl, int( b.healthy )
+            yield 'pinhole_backend_sessions_active', bl, b.active
+            yield 'pinhole_dns_hits_total', bl, b.resolver.hits
+            yield 'pinhole_dns_misses_total', bl, b.resolver.misses
+            yield 'pinhole_dns_failures_total', bl, b.resolver.failures
+
+
+class Pinhole( Listener, Thread ):
+    def __init__( self, port, targets, opts = None, shaper = None, admission = None, sock = None ):
+        # the accept thread must not keep a draining process alive
+        Thread.__init__( self, daemon = True )
+        Listener.__init__( self, port, targets, opts, shaper, admission, sock )
+        # a socket handed over from the async engine may be non-blocking
+        self.sock.setblocking( True )
+
+    def start_background( self ):
+        """start pools for the backends and whichever loops aren't running yet"""
+        for b in self.backends:
+            if b.pool:
+                Thread( target = b.pool.run, daemon = True ).start()
+        if self.health_checks() and not self.checking:
+            self.checking = True
+            Thread( target = self.check_backends, daemon = True ).start()
+        if self.reaper_needed() and not self.reaping:
+            self.reaping = True
+            Thread( target = self.reap_sessions, daemon = True ).start()
+
+    def check_backends( self ):
+        while self.health_checks() and not self.stopped:
+            for b in self.backends:
+                b.check()
+            time.sleep( self.opts.health_interval )
+        self.checking = False
+
+    def reap_sessions( self ):
+        while self.reaper_needed():
+            time.sleep( REAP_INTERVAL )
+            self.reap()
+        self.reaping = False
+
+    def stop( self, shared = False ):
+        Listener.stop( self, shared )
+        if not shared:
+            # wakes up the accept() blocked in run()
+            try:
+                self.sock.shutdown( socket.SHUT_RDWR )
+            except OSError:
+                pass
+        # otherwise a blocked accept() may still take one more session, and serve it
+        self.sock.close()
 
     def run( self ):
+        self.start_background()
+        while not self.stopped:
+            try:
+                newsock, address = self.sock.accept()
+            except OSError as e:
+                if self.stopped:
+                    return
+                # eg. out of fds, back off instead of spinning
+                log( 'Accept failed: %s', e, level = WARNING )
+                self.error( 'accept', e )
+                time.sleep( 0.1 )
+                continue
+            self.accepted += 1
+            self.admit( newsock, peer( address ))
+
+    def dispatch( self, newsock, address ):
+        # connect off the accept thread so a slow backend can't block it
+        Thread( target = self.session, args = ( newsock, address ), daemon = True ).start()
+
+    def session( self, newsock, address ):
+        if not self.tune_client( newsock ):
+            self.session_failed( newsock, address )
+            return
+        backend = self.balancer.pick( address[0] )
+        backend.acquire()
+        started = time.monotonic()
+        try:
+            fwd = backend.connect( self.proxy_header( newsock ))
+        except OSError as e:
+            log( 'Connect to %s failed: %s', backend, e, level = WARNING )
+            self.error( 'connect', e )
+            backend.release()
+            self.session_failed( newsock, address )
+            return
+        session = self.open_session( newsock, fwd, address, backend,
+            time.monotonic() - started )
+        PipeThread( session, newsock, fwd, self.opts ).start()
+        PipeThread( session, fwd, newsock, self.opts ).start()
+
+
+async def wait_fd( loop, fd, write = False ):
+    """wait until fd is readable (or writable) on the event loop"""
+    fut = loop.create_future()
+    add, remove = (( loop.add_writer, loop.remove_writer ) if write
+        else ( loop.add_reader, loop.remove_reader ))
+    add( fd, lambda: fut.done() or fut.set_result( None ))
+    try:
+        await fut
+    finally:
+        remove( fd )
+
+
+class AsyncPipe( object ):
+    """one direction of a session, run as a task on the event loop"""
+    def __init__( self, session, source, sink, opts ):
+        self.session = session
+        self.source = source
+        self.sink = sink
+        self.opts = opts
+        self.sent = 0
+        self.quickack = 'quickack' in session.tcp_options( source )
+        self.direction = len( session.pipes )
+        session.pipes.append( self )
+
+        log( 'Creating new pipe task %s for session %s', self, session.id, level = DEBUG )
+
+    async def run( self ):
+        loop = asyncio.get_running_loop()
+        try:
+            if not ( self.opts.splice and not self.session.capture
+                    and await self.relay_splice( loop )):
+                await self.relay_copy( loop )
+        except OSError as e:
+            self.session.listener.error( 'relay', e )
+            self.session.abort()
+            self.session.end_capture( self, False )
+        else:
+            half_close( self.sink )
+            self.session.end_capture( self, True )
+
+        log( '%s terminating', self, level = DEBUG )
+        self.session.pipe_done()
+
+    async def relay_copy( self, loop ):
+        budget = self.session.budget
+        buf = None if budget else memoryview( bytearray( self.session.chunk ))
+        capture = self.session.capture
         while True:
-            newsock, address = self.sock.accept()
-            log( 'Creating new session for %s %s ' % address )
-            fwd = socket( AF_INET, SOCK_STREAM )
-            fwd.connect(( self.newhost, self.newport ))
-            PipeThread( newsock, fwd ).start()
-            PipeThread( fwd, newsock ).start()
+            tail = None
+            if budget:
+                await wait_fd( loop, self.sink.fileno(), write = True )
+                await wait_fd( loop, self.source.fileno() )
+                buf = await budget.take_async( self.session.chunk, self )
+            try:
+                n = await loop.sock_recv_into( self.source, buf )
+                if not n: break
+                if self.quickack:
+                    self.source.setsockopt( socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1 )
+                self.session.last_active = time.monotonic()
+                wait = self.session.shape( n )
+                if wait:
+                    await asyncio.sleep( wait )
+                if budget:
+                    sent = send_some( self.sink, buf[:n] )
+                    if sent < n:
+                        tail = bytes( buf[sent:n] )
+                else:
+                    await loop.sock_sendall( self.sink, buf[:n] )
+                if capture:
+                    capture.data( self.session.id, self.direction, self.sent, buf[:n] )
+                self.sent += n
+            finally:
+                if budget:
+                    budget.give( buf )
+            if tail:
+                await loop.sock_sendall( self.sink, tail )
 
+    async def relay_splice( self, loop ):
+        """non-blocking splice, returns False if these fds can't be spliced"""
+        src, dst = self.source.fileno(), self.sink.fileno()
+        flags = SPLICE_FLAGS | os.SPLICE_F_NONBLOCK
+        rfd, wfd = os.pipe()
+        moved = False
+        try:
+            while True:
+                try:
+                    n = os.splice( src, wfd, self.session.chunk, flags = flags )
+                except BlockingIOError:
+                    await wait_fd( loop, src )
+                    continue
+                except OSError as e:
+                    if not moved and splice_unsupported( e ):
+                        return False
+                    raise
+                if not n: return True
+                moved = True
+                if self.quickack:
+                    self.source.setsockopt( socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1 )
+                self.session.last_active = time.monotonic()
+                wait = self.session.shape( n )
+                if wait:
+                    await asyncio.sleep( wait )
+                while n:
+                    try:
+                        m = os.splice( rfd, dst, n, flags = flags )
+                    except BlockingIOError:
+                        await wait_fd( loop, dst, write = True )
+                        continue
+                    self.sent += m
+                    n -= m
+        finally:
+            os.close( rfd )
+            os.close( wfd )
+
+
+class AsyncPinhole( Listener ):
+    """Pinhole listener that forwards every session on one event loop"""
+    def __init__( self, port, targets, opts = None, shaper = None, admission = None, sock = None ):
+        Listener.__init__( self, port, targets, opts, shaper, admission, sock )
+        self.sock.setblocking( False )
+        self.tasks = set()
+        self.runner = None
+        self.loop = None
+
+    def start( self ):
+        """start accepting, must be called on the event loop"""
+        self.loop = asyncio.get_running_loop()
+        self.runner = self.loop.create_task( self.run() )
+        return self.runner
+
+    def dispatch( self, newsock, address ):
+        # queued connections are let in by whichever thread frees up a slot
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self.spawn( self.session( newsock, address ))
+        else:
+            self.loop.call_soon_threadsafe( lambda: self.spawn( self.session( newsock, address )))
+
+    def stop( self, shared = False ):
+        Listener.stop( self, shared )
+        self.runner.cancel()
+        # close once run() has let go of the fd
+        self.runner.add_done_callback( lambda task: self.sock.close() )
+
+    def spawn( self, coro ):
+        # keep a reference so running tasks are not garbage collected
+        task = asyncio.get_running_loop().create_task( coro )
+        self.tasks.add( task )
+        task.add_done_callback( self.tasks.discard )
+        return task
+
+    def start_background( self ):
+        """start pools for the backends and whichever loops aren't running yet"""
+        for b in self.backends:
+            if b.pool:
+                self.spawn( b.pool.run_async() )
+        if self.health_checks() and not self.checking:
+            self.checking = True
+            self.spawn( self.check_backends() )
+        if self.reaper_needed() and not self.reaping:
+            self.reaping = True
+            self.spawn( self.reap_sessions() )
+
+    async def run( self ):
+        loop = asyncio.get_running_loop()
+        self.start_background()
+        while True:
+            await wait_fd( loop, self.sock.fileno() )
+            # drain everything the kernel has queued in one wakeup
+            for _ in range( ACCEPT_BATCH ):
+                try:
+                    newsock, address = self.sock.accept()
+                except BlockingIOError:
+                    break
+                except OSError as e:
+                    log( 'Accept failed: %s', e, level = WARNING )
+                    self.error( 'accept', e )
+                    await asyncio.sleep( 0.1 )
+                    break
+                self.accepted += 1
+                self.admit( newsock, peer( address ))
+
+    async def check_backends( self ):
+        while self.health_checks() and not self.stopped:
+            await asyncio.gather( *[ b.check_async() for b in self.backends ] )
+            await asyncio.sleep( self.opts.health_interval )
+        self.checking = False
+
+    async def reap_sessions( self ):
+        while self.reaper_needed():
+            await asyncio.sleep( REAP_INTERVAL )
+            self.reap()
+        self.reaping = False
+
+    async def session( self, newsock, address ):
+        newsock.setblocking( False )
+        if not self.tune_client( newsock ):
+            self.session_failed( newsock, address )
+            return
+        backend = self.balancer.pick( address[0] )
+        backend.acquire()
+        started = time.monotonic()
+        try:
+            fwd = await backend.connect_async( self.proxy_header( newsock ))
+        except OSError as e:
+            log( 'Connect to %s failed: %s', backend, e, level = WARNING )
+            self.error( 'connect', e )
+            backend.release()
+            self.session_failed( newsock, address )
+            return
+        session = self.open_session( newsock, fwd, address, backend,
+            time.monotonic() - started )
+        await asyncio.gather(
+            AsyncPipe( session, newsock, fwd, self.opts ).run(),
+            AsyncPipe( session, fwd, newsock, self.opts ).run() )
 
-if __name__ == '__main__':
-    print 'Starting Pinhole'
 
-    if len( sys.argv ) > 1:
-        port = newport = int( sys.argv[1] )
-        newhost = sys.argv[2]
-        if len( sys.argv ) >= 4: newport = int( sys.argv[3] )
-        Pinhole( port, newhost, newport ).start()
+class Flow( object ):
+    """a udp client address and the upstream socket its datagrams go out on"""
+    def __init__( self, client, upstream, backend ):
+        self.id = next( Session.ids )
+        # the raw address replies go to, and the one logs and labels use
+        self.client = client
+        self.address = peer( client )
+        self.upstream = upstream
+        self.backend = backend
+        self.connect_time = 0
+        self.started = time.monotonic()
+        self.last_active = self.started
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.datagrams_in = 0
+        self.datagrams_out = 0
+        # shaping doesn't apply, these keep the session stats uniform
+        self.buckets = []
+        self.throttled = 0.0
+        self.task = None
+
+
+class UdpPinhole( AsyncPinhole ):
+    """forwards datagrams through a flow per client address"""
+    def __init__( self, port, targets, opts = None, shaper = None, admission = None, sock = None ):
+        AsyncPinhole.__init__( self, port, targets, opts, shaper, admission, sock )
+        # flows live in self.sessions so stats and metrics treat them alike
+        self.flows = {}
+        self.dropped = 0
+        # one buffer for client datagrams, one shared by every flow's replies
+        self.client_buf = memoryview( bytearray( UDP_MAX ))
+        self.reply_buf = memoryview( bytearray( UDP_MAX ))
+
+    def health_checks( self ):
+        return False
+
+    def timeouts( self ):
+        return True
+
+    def reap( self ):
+        """close flows idle, or open, for too long, this is how udp flows end"""
+        now = time.monotonic()
+        idle, limit = self.opts.idle_timeout or UDP_IDLE, self.opts.session_timeout
+        for flow in list( self.flows.values() ):
+            if ( now - flow.last_active > idle
+                    or limit and now - flow.started > limit ):
+                self.close_flow( flow )
+        # replies go out through the listening socket, so it outlives stop()
+        if self.stopped and not self.flows:
+            self.sock.close()
+
+    def stop( self, shared = False ):
+        Listener.stop( self, shared )
+        self.runner.cancel()
+
+    def abort_sessions( self ):
+        for flow in list( self.flows.values() ):
+            self.close_flow( flow )
+
+    async def run( self ):
+        loop = asyncio.get_running_loop()
+        self.start_background()
+        while True:
+            await wait_fd( loop, self.sock.fileno() )
+            for _ in range( UDP_BATCH ):
+                try:
+                    n, client = self.sock.recvfrom_into( self.client_buf )
+                except BlockingIOError:
+                    break
+                except OSError as e:
+                    self.error( 'recv', e )
+                    break
+                flow = self.flows.get( client ) or await self.open_flow( client )
+                if flow is None:
+                    continue
+                try:
+                    flow.upstream.send( self.client_buf[:n] )
+                except OSError as e:
+                    # a full send buffer or an icmp error, udp just drops it
+                    self.dropped += 1
+                    self.error( 'send', e )
+                    continue
+                flow.datagrams_in += 1
+                flow.bytes_in += n
+                flow.last_active = time.monotonic()
+
+    async def open_flow( self, client ):
+        backend = self.balancer.pick( peer( client )[0] )
+        try:
+            addr = await backend.resolver.resolve_async()
+            sock = socket.socket( family_of( addr ), socket.SOCK_DGRAM )
+        except OSError as e:
+            log( 'Connect to %s failed: %s', backend, e, level = WARNING )
+            self.error( 'connect', e )
+            return None
+        sock.setblocking( False )
+        try:
+            sock.connect( addr )
+        except OSError as e:
+            log( 'Connect to %s failed: %s', backend, e, level = WARNING )
+            self.error( 'connect', e )
+            sock.close()
+            return None
+        backend.acquire()
+        flow = Flow( client, sock, backend )
+        self.flows[ client ] = flow
+        self.sessions.add( flow )
+        self.accepted += 1
+        flow.task = self.spawn( self.relay_replies( flow ))
+        log( 'Flow %s opened for %s %s, %s flows active',
+            flow.id, flow.address[0], flow.address[1], len( self.flows ),
+            sample = True, event = 'open', session = flow.id, listen = self.port,
+            client = flow.address[0], backend = backend )
+        return flow
+
+    def close_flow( self, flow ):
+        del self.flows[ flow.client ]
+        flow.task.cancel()
+        flow.upstream.close()
+        self.close_session( flow )
+
+    async def relay_replies( self, flow ):
+        loop = asyncio.get_running_loop()
+        while True:
+            await wait_fd( loop, flow.upstream.fileno() )
+            for _ in range( UDP_BATCH ):
+                try:
+                    n = flow.upstream.recv_into( self.reply_buf )
+                except BlockingIOError:
+                    break
+                except OSError as e:
+                    # eg. connection refused from an icmp port unreachable
+                    self.error( 'recv', e )
+                    continue
+                try:
+                    self.sock.sendto( self.reply_buf[:n], flow.client )
+                except OSError as e:
+                    self.dropped += 1
+                    self.error( 'send', e )
+                    continue
+                flow.datagrams_out += 1
+                flow.bytes_out += n
+                flow.last_active = time.monotonic()
+
+    def stats( self ):
+        stats = AsyncPinhole.stats( self )
+        stats['dropped'] = self.dropped
+        return stats
+
+    def absorb( self, other ):
+        AsyncPinhole.absorb( self, other )
+        self.dropped += other.dropped
+
+    def metrics( self ):
+        yield from AsyncPinhole.metrics( self )
+        labels = { 'listen': self.port }
+        yield 'pinhole_udp_dropped_total', labels, self.dropped
+        for flow in list( self.flows.values() ):
+            fl = dict( labels, session = flow.id, client = flow.address[0] )
+            yield 'pinhole_udp_flow_datagrams_in', fl, flow.datagrams_in
+            yield 'pinhole_udp_flow_datagrams_out', fl, flow.datagrams_out
+
+
+METRIC_TYPES = {
+    'pinhole_accepted_total': 'counter',
+    'pinhole_sessions_closed_total': 'counter',
+    'pinhole_bytes_in_total': 'counter',
+    'pinhole_bytes_out_total': 'counter',
+    'pinhole_errors_total': 'counter',
+    'pinhole_connect_seconds': 'histogram',
+    'pinhole_dns_hits_total': 'counter',
+    'pinhole_dns_misses_total': 'counter',
+    'pinhole_dns_failures_total': 'counter',
+    'pinhole_throttled_seconds_total': 'counter',
+    'pinhole_udp_dropped_total': 'counter',
+    'pinhole_admission_queued_total': 'counter',
+    'pinhole_capture_written_total': 'counter',
+    'pinhole_capture_dropped_total': 'counter',
+    'pinhole_budget_paused_seconds_total': 'counter',
+}
+
+
+def metrics_text( pinholes ):
+    """render every listener's metrics in the prometheus text format
+
+    a retired listener and the one that replaced it report the same
+    series, those are added up"""
+    families = collections.OrderedDict()
+    for p in pinholes:
+        for name, labels, value in p.metrics():
+            family = name
+            for suffix in ( '_bucket', '_sum', '_count' ):
+                if name.endswith( suffix ) and name[:-len( suffix )] in METRIC_TYPES:
+                    family = name[:-len( suffix )]
+            samples = families.setdefault( family, collections.OrderedDict() )
+            key = ( name, tuple( labels.items() ))
+            samples[ key ] = samples.get( key, 0 ) + value
+    lines = []
+    for family, samples in families.items():
+        lines.append( '# TYPE %s %s' % ( family, METRIC_TYPES.get( family, 'gauge' )))
+        for ( name, labels ), value in samples.items():
+            lines.append( '%s{%s} %s' % ( name, ','.join( '%s="%s"' % ( k, str( v ).replace( '"', '\\"' ))
+                for k, v in labels ), value ))
+    return '\n'.join( lines ) + '\n'
+
+
+class MetricsHandler( BaseHTTPRequestHandler ):
+    # returns the listeners to report on
+    listeners = list
+
+    def do_GET( self ):
+        body = metrics_text( self.listeners() ).encode()
+        self.send_response( 200 )
+        self.send_header( 'Content-Type', 'text/plain; version=0.0.4' )
+        self.send_header( 'Content-Length', str( len( body )))
+        self.end_headers()
+        self.wfile.write( body )
+
+    def log_message( self, *args ):
+        pass
+
+
+def start_metrics( address, listeners ):
+    """serve metrics for the listeners() returns from a background thread"""
+    handler = type( 'Handler', ( MetricsHandler, ), { 'listeners': staticmethod( listeners )})
+    if '/' in address:
+        remove_stale_socket( address )
+        server = ThreadingUnixStreamServer( address, handler )
     else:
-        Pinhole( 8080, 'google.com', 80 ).start()
-        Pinhole( 8081, 'google.com', 443 ).start()
+        host, _, port = address.rpartition( ':' )
+        server = ThreadingHTTPServer(( host or '127.0.0.1', int( port )), handler )
+    server.daemon_threads = True
+    Thread( target = server.serve_forever, daemon = True ).start()
+    log( 'Serving metrics on %s', address )
+    return server
+
+
+def worker_metrics( address, n ):
+    """the metrics address for worker n, so workers don't collide"""
+    if '/' in address:
+        return '%s.%s' % ( address, n )
+    host, _, port = address.rpartition( ':' )
+    return '%s:%s' % ( host, int( port ) + n ) if host else str( int( port ) + n )
+
+
+def log_stats( pinholes ):
+    for p in pinholes:
+        stats = p.stats()
+        backends = stats.pop( 'backends' )
+        stats['log_dropped'] = DroppingQueueHandler.dropped
+        if CAPTURE:
+            stats['capture_dropped'] = CAPTURE.dropped
+        log( 'stats %s', ' '.join( '%s=%s' % kv for kv in stats.items() ), **stats )
+        for b in backends:
+            log( 'stats listen=%s %s', p.port, ' '.join( '%s=%s' % kv for kv in b.items() ),
+                listen = p.port, **b )
+
+
+# options that need a new listening socket when they change on reload
+REBIND_OPTIONS = ( 'udp', 'engine', 'client_tcp', 'backlog' )
+# the ones of those that mean anything to a udp listener
+UDP_REBIND_OPTIONS = ( 'udp', )
+# options a --config section can't set, they belong to the whole process
+PROCESS_OPTIONS = ( 'config', 'workers', 'metrics', 'log_level', 'log_sample',
+    'log_json', 'log_file', 'rate_client', 'rate_global', 'drain_timeout', 'handoff',
+    'max_sessions', 'max_client_sessions', 'client_conn_rate', 'overflow', 'queue_timeout',
+    'capture', 'capture_size', 'memory_budget' )
+
+
+def load_config( opts ):
+    """[( port, targets, opts ), ... ] for every listener in opts.config"""
+    if opts.config.endswith( '.toml' ):
+        if tomllib is None:
+            raise ValueError( 'TOML config needs Python 3.11 or later' )
+        with open( opts.config, 'rb' ) as f:
+            sections = tomllib.load( f )
+    else:
+        ini = configparser.ConfigParser( interpolation = None )
+        with open( opts.config ) as f:
+            try:
+                ini.read_file( f )
+            except configparser.Error as e:
+                raise ValueError( e.message )
+        sections = { name: dict( ini[ name ] ) for name in ini.sections() }
+
+    parser = make_parser()
+    def error( message ):
+        raise ValueError( message )
+    parser.error = error
+
+    mappings = []
+    for name, section in sections.items():
+        try:
+            port = parse_listen( name )
+        except ValueError:
+            raise ValueError( 'section [%s] is not a listen address' % name )
+        argv = []
+        for key, value in section.items():
+            key = key.replace( '_', '-' )
+            if key.replace( '-', '_' ) in PROCESS_OPTIONS:
+                raise ValueError( '[%s] %s can only be given on the command line' % ( name, key ))
+            if isinstance( value, str ) and key == 'backend':
+                value = value.split()
+            if isinstance( value, str ) and value.lower() in ( 'yes', 'true', 'on', 'no', 'false', 'off' ):
+                value = value.lower() in ( 'yes', 'true', 'on' )
+            for v in value if isinstance( value, list ) else [ value ]:
+                if v is True:
+                    argv.append( '--' + key )
+                elif v is not False:
+                    argv += [ '--' + key, str( v ) ]
+        lopts = copy.copy( opts )
+        lopts.backend = []
+        try:
+            parser.parse_args( argv, namespace = lopts )
+            targets = [ parse_target( b, listen_port( port )) for b in lopts.backend ]
+            check_mapping( port, targets, lopts )
+        except ValueError as e:
+            raise ValueError( '[%s] %s' % ( name, e ))
+        mappings.append(( port, targets, lopts ))
+    if len( set( m[0] for m in mappings )) < len( mappings ):
+        raise ValueError( 'a listen address is listed twice' )
+    return mappings
+
+
+def check_mapping( listen, targets, opts ):
+    """raise ValueError for a listener that can't work with its options"""
+    if not targets:
+        raise ValueError( 'needs a backend' )
+    for host, port in targets:
+        if not port and '/' not in host:
+            raise ValueError( 'no port for %s' % host )
+    unix = listen_port( listen ) is None or any( port is None for host, port in targets )
+    if opts.udp and unix:
+        raise ValueError( '--udp needs IP addresses, not unix sockets' )
+    if opts.udp and opts.pool:
+        raise ValueError( '--pool only applies to TCP' )
+    if opts.udp and opts.proxy_protocol:
+        raise ValueError( '--proxy-protocol only applies to TCP' )
+    if opts.workers and listen_port( listen ) is None:
+        raise ValueError( 'a unix socket listener does not work with --workers' )
+    if opts.low_water is not None and not opts.high_water:
+        raise ValueError( '--low-water needs --high-water' )
+    if opts.high_water:
+        if not hasattr( socket, 'TCP_NOTSENT_LOWAT' ):
+            raise ValueError( '--high-water needs TCP_NOTSENT_LOWAT' )
+        high, low = watermarks( opts )
+        if high - low < MIN_BURST:
+            raise ValueError( '--high-water must be at least %s above --low-water' % MIN_BURST )
+
+
+def targets_of( opts ):
+    """the checked ( host, port ) targets for opts.port, from host, newport and --backend"""
+    port = listen_port( opts.port )
+    try:
+        targets = [ parse_target( b, port ) for b in opts.backend ]
+    except ValueError:
+        raise ValueError( 'invalid --backend' )
+    if opts.newhost is not None:
+        if '/' in opts.newhost:
+            targets.insert( 0, ( opts.newhost, None ))
+        else:
+            targets.insert( 0, ( opts.newhost, opts.newport or port ))
+    if not targets:
+        raise ValueError( 'host or --backend is required' )
+    check_mapping( opts.port, targets, opts )
+    return targets
+
+
+def take_over( path ):
+    """listening sockets from the pinhole serving --handoff on path, by ( port, udp )"""
+    conn = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+    conn.settimeout( HANDOFF_TIMEOUT )
+    try:
+        conn.connect( path )
+    except OSError:
+        # nobody to take over from, start from scratch
+        conn.close()
+        return {}
+    with conn:
+        msg, fds, flags, addr = socket.recv_fds( conn, HANDOFF_MSG, HANDOFF_MAX_FDS )
+        socks = { ( port, udp ): socket.socket( fileno = fd )
+            for ( port, udp ), fd in zip( json.loads( msg ), fds ) }
+        conn.sendall( b'k' )
+        # the old process hangs up once it has stopped accepting
+        try:
+            conn.recv( 1 )
+        except OSError:
+            pass
+    log( 'Took over %s listening sockets from %s', len( socks ), path )
+    return socks
+
+
+class Server( object ):
+    """every listener in the process, rebuilt from --config on SIGHUP"""
+    def __init__( self, opts ):
+        self.opts = opts
+        # one set of buckets so the global and per client limits span every listener
+        self.shaper = Shaper( opts )
+        self.admission = Admission( opts )
+        self.pinholes = []
+        # listeners stopped by a reload that still have sessions open
+        self.retired = []
+        self.lock = threading.Lock()
+        self.inherited = {}
+        self.done = None
+        self.draining = False
+        self.drainer = None
+        self.rebuilder = None
+        self.handed_off = False
+        self.stopped_accepting = threading.Event()
+
+    def add( self, port, targets, opts ):
+        if opts.udp:
+            listener = UdpPinhole
+        elif opts.engine == 'async':
+            listener = AsyncPinhole
+        else:
+            listener = Pinhole
+        sock = self.inherited.pop(( port, opts.udp ), None )
+        p = listener( port, targets, opts, self.shaper, self.admission, sock )
+        with self.lock:
+            self.pinholes.append( p )
+        return p
+
+    def listeners( self ):
+        """the running listeners and the retired ones still finishing sessions"""
+        with self.lock:
+            for p in [ p for p in self.retired if not p.sessions ]:
+                self.retired.remove( p )
+                for q in self.pinholes:
+                    if ( q.port, q.opts.udp ) == ( p.port, p.opts.udp ):
+                        q.absorb( p )
+            return self.pinholes + self.retired
+
+    def open_sessions( self ):
+        return sum( len( p.sessions ) for p in self.listeners() )
+
+    def stop_accepting( self ):
+        for p in self.pinholes:
+            if not p.stopped:
+                p.stop( shared = self.handed_off )
+        self.stopped_accepting.set()
+        log( 'Draining %s sessions for up to %ss', self.open_sessions(), self.opts.drain_timeout )
+
+    def drain( self ):
+        """stop accepting and wait for open sessions, for the thread engine"""
+        self.stop_accepting()
+        deadline = time.monotonic() + self.opts.drain_timeout
+        while self.open_sessions() and time.monotonic() < deadline:
+            time.sleep( DRAIN_CHECK )
+
+    async def drain_async( self ):
+        self.stop_accepting()
+        deadline = time.monotonic() + self.opts.drain_timeout
+        while self.open_sessions() and time.monotonic() < deadline:
+            await asyncio.sleep( DRAIN_CHECK )
+        if not self.done.done():
+            self.done.set_result( None )
+
+    def shutdown( self ):
+        """the first SIGTERM or ^C drains, a second one exits straight away"""
+        if self.draining:
+            if not self.done.done():
+                self.done.set_result( None )
+            return
+        self.draining = True
+        self.drainer = asyncio.get_running_loop().create_task( self.drain_async() )
+
+    def abort( self ):
+        n = self.open_sessions()
+        if n:
+            log( 'Exiting with %s sessions still open', n, level = WARNING )
+        for p in self.listeners():
+            p.abort_sessions()
+
+    def listen_handoff( self, path ):
+        remove_stale_socket( path )
+        server = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+        server.bind( path )
+        server.listen( 1 )
+        Thread( target = self.hand_off, args = ( server, ), daemon = True ).start()
+
+    def hand_off( self, server ):
+        """pass the listening sockets to the next pinhole to connect, then drain"""
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                pinholes = [ p for p in list( self.pinholes ) if not p.stopped ]
+                msg = json.dumps([[ p.port, p.opts.udp ] for p in pinholes ]).encode()
+                try:
+                    conn.settimeout( HANDOFF_TIMEOUT )
+                    socket.send_fds( conn, [ msg ], [ p.sock.fileno() for p in pinholes ] )
+                    if conn.recv( 1 ) != b'k':
+                        raise ConnectionError( 'no acknowledgement' )
+                except OSError as e:
+                    log( 'Handoff failed, still serving: %s', e, level = WARNING )
+                    continue
+                log( 'Handed %s listening sockets over, draining', len( pinholes ))
+                self.handed_off = True
+                os.kill( os.getpid(), signal.SIGTERM )
+                # keep the new process waiting until we no longer accept
+                self.stopped_accepting.wait( HANDOFF_TIMEOUT )
+                # before hanging up, so the path is free when the new process listens on it
+                server.close()
+            return
+
+    def start( self, p ):
+        runner = p.start()
+        if runner is not None:
+            runner.add_done_callback( self.finished )
+
+    def finished( self, task ):
+        # a listener that crashes takes the process down, as gather() would
+        if not task.cancelled() and task.exception() and not self.done.done():
+            self.done.set_exception( task.exception() )
+
+    def reload( self ):
+        log( 'Reloading %s', self.opts.config )
+        try:
+            mappings = load_config( self.opts )
+        except ( OSError, ValueError ) as e:
+            log( 'Reload failed, keeping the current listeners: %s', e, level = WARNING )
+            return
+        self.rebuilder = asyncio.get_running_loop().create_task( self.rebuild( mappings ))
+
+    async def rebuild( self, mappings ):
+        """retire the listeners mappings drops or rebinds, then start and reconfigure the rest"""
+        wanted = { port: ( targets, opts ) for port, targets, opts in mappings }
+        stopping = []
+        for p in list( self.pinholes ):
+            new = wanted.get( p.port )
+            rebind = UDP_REBIND_OPTIONS if p.opts.udp else REBIND_OPTIONS
+            if new is None or any( getattr( p.opts, o ) != getattr( new[1], o ) for o in rebind ):
+                if new and p.opts.udp and new[1].udp:
+                    # the old flows still reply through this socket until they
+                    # expire, so the replacement shares it instead of binding again
+                    self.inherited[ p.port, True ] = p.sock.dup()
+                p.stop()
+                p.retired = True
+                with self.lock:
+                    self.pinholes.remove( p )
+                    self.retired.append( p )
+                if isinstance( p, AsyncPinhole ):
+                    stopping.append( p.runner )
+        # an async listener's socket closes when its runner ends, rebinding before that fails
+        if stopping:
+            await asyncio.wait( stopping )
+        running = { p.port: p for p in self.pinholes }
+        for port, ( targets, opts ) in wanted.items():
+            p = running.get( port )
+            if p is None:
+                try:
+                    self.start( self.add( port, targets, opts ))
+                except OSError as e:
+                    log( 'Listening on %s failed: %s', port, e, level = WARNING )
+            elif ( p.targets, p.opts ) != ( targets, opts ):
+                p.reconfigure( targets, opts )
+
+    async def run_async( self ):
+        loop = asyncio.get_running_loop()
+        self.done = loop.create_future()
+        loop.add_signal_handler( signal.SIGUSR1, lambda: log_stats( self.listeners() ))
+        loop.add_signal_handler( signal.SIGTERM, self.shutdown )
+        # workers leave ^C to their parent
+        if signal.getsignal( signal.SIGINT ) is not signal.SIG_IGN:
+            loop.add_signal_handler( signal.SIGINT, self.shutdown )
+        if self.opts.config:
+            loop.add_signal_handler( signal.SIGHUP, self.reload )
+        for p in self.pinholes:
+            self.start( p )
+        await self.done
+
+
+# command line options a Forwarder doesn't take, they belong to the pinhole process
+COMMAND_OPTIONS = ( 'port', 'newhost', 'newport', 'config', 'workers', 'handoff', 'metrics',
+    'log_level', 'log_sample', 'log_json', 'log_file', 'capture', 'capture_size' )
+
+
+class Forwarder( object ):
+    """pinhole as a library, forwarding one listen address until stopped
+
+    start() runs it on an event loop thread of its own and start_async()
+    on the running loop, and both work as context managers. Options are
+    the long command line ones with - as _, given as parsed values, eg.
+    Forwarder( 0, 'db', 5432, engine = 'async', rate_session = 1 << 20 ).
+    Listen on port 0 to get a free port from address. Logging goes to
+    the 'pinhole' logger, left for the embedding program to set up."""
+    def __init__( self, listen, host = None, newport = None, **options ):
+        opts = default_opts()
+        for name, value in options.items():
+            if name in COMMAND_OPTIONS or not hasattr( opts, name ):
+                raise TypeError( 'Forwarder got an unexpected option %r' % name )
+            setattr( opts, name, value )
+        opts.engine = opts.engine or 'thread'
+        opts.port = parse_listen( listen ) if isinstance( listen, str ) else listen
+        opts.newhost, opts.newport = host, newport
+        self.opts = opts
+        self.targets = targets_of( opts )
+        self.server = None
+        self.listener = None
+        self.loop = None
+        self.thread = None
+
+    @property
+    def address( self ):
+        """the address listened on, with the real port when it was 0"""
+        return self.listener.sock.getsockname()
+
+    async def start_async( self ):
+        """start forwarding on the running event loop"""
+        self.loop = asyncio.get_running_loop()
+        self.server = Server( self.opts )
+        self.server.done = self.loop.create_future()
+        self.listener = self.server.add( self.opts.port, self.targets, self.opts )
+        self.server.start( self.listener )
+        return self
+
+    async def stop_async( self, drain = 0 ):
+        """stop accepting, give open sessions drain seconds to finish, then abort the rest"""
+        server = self.server
+        server.stop_accepting()
+        deadline = time.monotonic() + drain
+        while server.open_sessions() and time.monotonic() < deadline:
+            await asyncio.sleep( DRAIN_CHECK )
+        server.abort()
+        deadline = time.monotonic() + STOP_TIMEOUT
+        while server.open_sessions() and time.monotonic() < deadline:
+            await asyncio.sleep( DRAIN_CHECK )
+        if isinstance( self.listener, AsyncPinhole ):
+            # health checks, pools and the reaper would otherwise outlive us
+            tasks = list( self.listener.tasks ) + [ self.listener.runner ]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather( *tasks, return_exceptions = True )
+        # a udp listener only closes it from the reaper, cancelled above
+        self.listener.sock.close()
+
+    def start( self ):
+        """start forwarding on an event loop thread of its own, returns once listening"""
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread( target = self.loop.run_forever, daemon = True )
+        self.thread.start()
+        try:
+            asyncio.run_coroutine_threadsafe( self.start_async(), self.loop ).result()
+        except BaseException:
+            self.close_loop()
+            raise
+        return self
+
+    def stop( self, drain = 0 ):
+        asyncio.run_coroutine_threadsafe( self.stop_async( drain ), self.loop ).result()
+        self.close_loop()
+
+    def close_loop( self ):
+        self.loop.call_soon_threadsafe( self.loop.stop )
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__( self ):
+        return self.start()
+
+    def __exit__( self, *exc ):
+        self.stop()
+
+    async def __aenter__( self ):
+        return await self.start_async()
+
+    async def __aexit__( self, *exc ):
+        await self.stop_async()
+
+    def stats( self ):
+        """what SIGUSR1 logs for the listener, with running totals added"""
+        p = self.listener
+        live = list( p.sessions )
+        stats = p.stats()
+        stats.update(
+            accepted = p.accepted,
+            closed = p.closed,
+            bytes_in = p.closed_bytes_in + sum( s.bytes_in for s in live ),
+            bytes_out = p.closed_bytes_out + sum( s.bytes_out for s in live ),
+            errors = { '%s/%s' % key: n for key, n in list( p.errors.items() )})
+        return stats
+
+
+def serve( mappings, opts ):
+    """run a listener per ( port, [( host, port ), ... ], opts ) mapping until interrupted"""
+    start_logging( opts )
+    start_capture( opts )
+    server = Server( opts )
+    if opts.handoff:
+        server.inherited = take_over( opts.handoff )
+    for m in mappings:
+        server.add( *m )
+    # the old process is draining these anyway
+    for sock in server.inherited.values():
+        sock.close()
+    if opts.handoff:
+        server.listen_handoff( opts.handoff )
+    if opts.metrics:
+        start_metrics( opts.metrics, server.listeners )
+    if opts.config or not all( isinstance( p, Pinhole ) for p in server.pinholes ):
+        try:
+            asyncio.run( server.run_async() )
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        # session threads of any thread engine listeners would keep us alive
+        server.abort()
+        return
+
+    pinholes = server.pinholes
+    signal.signal( signal.SIGUSR1, lambda signum, frame: log_stats( server.listeners() ))
+    signal.signal( signal.SIGTERM, lambda signum, frame: sys.exit() )
+    for p in pinholes:
+        p.start()
 
     try:
         while 1:
             time.sleep(2)
     except (KeyboardInterrupt, SystemExit):
-        os.kill(os.getpid(), signal.SIGTERM)
+        try:
+            server.drain()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+    server.abort()
+
+
+def supervise( mappings, opts ):
+    """fork opts.workers processes running serve() and restart any that die"""
+    workers = {}
+
+    def spawn( n ):
+        pid = os.fork()
+        if pid == 0:
+            # the parent handles ^C and tells the workers to stop
+            signal.signal( signal.SIGINT, signal.SIG_IGN )
+            signal.signal( signal.SIGTERM, signal.SIG_DFL )
+            signal.signal( signal.SIGUSR1, signal.SIG_IGN )
+            signal.signal( signal.SIGHUP, signal.SIG_IGN )
+            status = 1
+            wopts = copy.copy( opts )
+            # each worker shapes on its own, so they share the global rate
+            wopts.rate_global = opts.rate_global / opts.workers
+            wopts.memory_budget = opts.memory_budget / opts.workers
+            # and the session cap, rounded up
+            wopts.max_sessions = -( -opts.max_sessions // opts.workers )
+            if opts.metrics:
+                wopts.metrics = worker_metrics( opts.metrics, n )
+            if opts.capture:
+                root, ext = os.path.splitext( opts.capture )
+                wopts.capture = '%s.%s%s' % ( root, n, ext )
+            # the parent's writer thread didn't survive the fork
+            start_logging( wopts )
+            try:
+                # reread so every listener shares this worker's options
+                serve( load_config( wopts ) if opts.config else mappings, wopts )
+                status = 0
+            except Exception as e:
+                log( 'Worker %s failed: %s', n, e, level = WARNING )
+            finally:
+                # os._exit() skips atexit, so close the capture and flush the log here
+                if CAPTURE:
+                    CAPTURE.stop()
+                stop_logging()
+                os._exit( status )
+        workers[pid] = ( n, time.monotonic() )
+        log( 'Started worker %s pid %s', n, pid )
+
+    def stop( signum, frame ):
+        raise SystemExit
+
+    def forward( signum, frame ):
+        for pid in workers:
+            os.kill( pid, signum )
+
+    start_logging( opts )
+    signal.signal( signal.SIGTERM, stop )
+    signal.signal( signal.SIGUSR1, forward )
+    signal.signal( signal.SIGHUP, forward )
+    for n in range( opts.workers ):
+        spawn( n )
+
+    try:
+        while True:
+            pid, status = os.wait()
+            if pid not in workers: continue
+            n, started = workers.pop( pid )
+            log( 'Worker %s pid %s exited with status %s, restarting',
+                n, pid, os.waitstatus_to_exitcode( status ), level = WARNING )
+            # don't spin if the worker dies straight away, eg. port in use
+            if time.monotonic() - started < 1:
+                time.sleep( 1 )
+            spawn( n )
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+    for pid in workers:
+        os.kill( pid, signal.SIGTERM )
+    for pid in workers:
+        os.waitpid( pid, 0 )
+
+
+async def bench_serve( sock ):
+    """echo every connection back, or discard it if it starts with BENCH_SINK"""
+    loop = asyncio.get_running_loop()
+    tasks = set()
+
+    async def handle( conn ):
+        buf = bytearray( BENCH_CHUNK )
+        sink = None
+        try:
+            while True:
+                n = await loop.sock_recv_into( conn, buf )
+                if not n: break
+                if sink is None:
+                    sink = buf[:1] == BENCH_SINK
+                if not sink:
+                    await loop.sock_sendall( conn, memoryview( buf )[:n] )
+        except OSError:
+            pass
+        conn.close()
+
+    while True:
+        conn, _ = await loop.sock_accept( sock )
+        conn.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+        task = loop.create_task( handle( conn ))
+        tasks.add( task )
+        task.add_done_callback( tasks.discard )
+
+
+async def bench_socket( address ):
+    sock = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+    sock.setblocking( False )
+    sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+    try:
+        await asyncio.get_running_loop().sock_connect( sock, address )
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+async def bench_round_trip( sock, request ):
+    """send request and wait for all of it to be echoed back"""
+    loop = asyncio.get_running_loop()
+    await loop.sock_sendall( sock, request )
+    buf = bytearray( len( request ))
+    view = memoryview( buf )
+    got = 0
+    while got < len( buf ):
+        n = await loop.sock_recv_into( sock, view[got:] )
+        if not n:
+            raise ConnectionResetError( 'connection closed mid request' )
+        got += n
+
+
+async def bench_bulk( address, deadline, bopts, tally ):
+    loop = asyncio.get_running_loop()
+    sock = await bench_socket( address )
+    data = BENCH_SINK * BENCH_CHUNK
+    try:
+        while time.monotonic() < deadline:
+            await loop.sock_sendall( sock, data )
+            tally['bytes'] += len( data )
+        sock.shutdown( socket.SHUT_WR )
+        # the sink closes once it has read everything, so it's all through
+        await loop.sock_recv( sock, 1 )
+    finally:
+        sock.close()
+
+
+async def bench_rps( address, deadline, bopts, tally ):
+    sock = await bench_socket( address )
+    request = b'r' * bopts.size
+    try:
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            await bench_round_trip( sock, request )
+            tally['latencies'].append( time.monotonic() - start )
+    finally:
+        sock.close()
+
+
+async def bench_connect( address, deadline, bopts, tally ):
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        sock = await bench_socket( address )
+        try:
+            # the forwarder only connects upstream once the client is accepted
+            await bench_round_trip( sock, b'c' )
+        finally:
+            sock.close()
+        tally['latencies'].append( time.monotonic() - start )
+
 
+BENCH_TESTS = collections.OrderedDict([
+    ( 'bulk', bench_bulk ), ( 'rps', bench_rps ), ( 'connect', bench_connect )])
+
+
+def percentile( values, p ):
+    """nearest rank percentile of a sorted list"""
+    return values[ min( len( values ) - 1, int( len( values ) * p / 100 ))]
+
+
+async def bench_run( test, address, bopts ):
+    """run one test with bopts.clients clients for bopts.duration seconds"""
+    tally = { 'bytes': 0, 'latencies': [], 'errors': 0 }
+    start = time.monotonic()
+    deadline = start + bopts.duration
+
+    async def client():
+        while time.monotonic() < deadline:
+            try:
+                await test( address, deadline, bopts, tally )
+            except OSError:
+                tally['errors'] += 1
+                await asyncio.sleep( 0.01 )
+
+    await asyncio.gather( *( client() for _ in range( bopts.clients )))
+    seconds = time.monotonic() - start
+    result = { 'seconds': round( seconds, 3 ), 'errors': tally['errors'] }
+    if tally['bytes']:
+        result['bytes'] = tally['bytes']
+        result['bytes_per_second'] = round( tally['bytes'] / seconds )
+    latencies = sorted( tally['latencies'] )
+    if latencies:
+        result['count'] = len( latencies )
+        result['per_second'] = round( len( latencies ) / seconds, 1 )
+        result['p50_ms'] = round( percentile( latencies, 50 ) * 1000, 3 )
+        result['p99_ms'] = round( percentile( latencies, 99 ) * 1000, 3 )
+    return result
+
+
+def bench_report( name, result ):
+    if 'bytes_per_second' in result:
+        line = '%.1f MB/s' % ( result['bytes_per_second'] / 1e6 )
+    elif 'per_second' in result:
+        line = '%.0f %s/s  p50 %.3fms  p99 %.3fms' % ( result['per_second'],
+            'req' if name == 'rps' else 'conn', result['p50_ms'], result['p99_ms'] )
+    else:
+        line = 'no results'
+    if result['errors']:
+        line += '  %d errors' % result['errors']
+    print( '%-8s %s' % ( name, line ), flush = True )
+
+
+def wait_listening( address, proc ):
+    """wait for the forwarder to accept connections, false if it never does"""
+    deadline = time.monotonic() + BENCH_START
+    while time.monotonic() < deadline and proc.poll() is None:
+        try:
+            socket.create_connection( address, timeout = 1 ).close()
+            return True
+        except OSError:
+            time.sleep( 0.05 )
+    return False
+
+
+def make_bench_parser():
+    parser = argparse.ArgumentParser( prog = 'pinhole bench',
+        description = 'Benchmark pinhole against a local echo server. Options not'
+            ' listed here are passed to the pinhole under test.' )
+    parser.add_argument( '--clients', type = int, default = 16,
+        help = 'concurrent clients in each test (default %(default)s)' )
+    parser.add_argument( '--duration', type = float, default = 5, metavar = 'SECONDS',
+        help = 'how long each test runs (default %(default)s)' )
+    parser.add_argument( '--size', type = size, default = 64, metavar = 'BYTES',
+        help = 'request size in the rps test (default %(default)s)' )
+    parser.add_argument( '--tests', default = ','.join( BENCH_TESTS ),
+        help = 'comma separated tests to run (default %(default)s)' )
+    parser.add_argument( '--direct', action = 'store_true',
+        help = 'connect straight to the echo server, for a baseline' )
+    return parser
+
+
+def bench( argv ):
+    """run pinhole bench with argv, returns the exit status"""
+    parser = make_bench_parser()
+    bopts, forward = parser.parse_known_args( argv )
+    bopts.size = int( bopts.size )
+    tests = bopts.tests.split( ',' )
+    for name in tests:
+        if name not in BENCH_TESTS:
+            parser.error( 'unknown test %r' % name )
+    if bopts.clients < 1 or bopts.size < 1:
+        parser.error( '--clients and --size must be at least 1' )
+    fopts = make_parser().parse_args( forward )
+    if fopts.port is not None or fopts.backend or fopts.config or fopts.udp:
+        parser.error( 'the forwarder under test always listens locally for TCP' )
+    if bopts.direct and forward:
+        parser.error( '--direct runs without a forwarder to pass %s to' % ' '.join( forward ))
+
+    echo = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+    echo.bind(( '127.0.0.1', 0 ))
+    echo.listen( socket.SOMAXCONN )
+    echo.setblocking( False )
+    server = os.fork()
+    if server == 0:
+        try:
+            asyncio.run( bench_serve( echo ))
+        finally:
+            os._exit( 0 )
+    echo_port = echo.getsockname()[1]
+    echo.close()
+
+    proc = None
+    address = ( '127.0.0.1', echo_port )
+    summary = { 'forwarder': None if bopts.direct else forward, 'clients': bopts.clients,
+        'duration': bopts.duration, 'size': bopts.size, 'tests': {} }
+    try:
+        if not bopts.direct:
+            # find a free port for the forwarder, it binds its own socket
+            probe = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+            probe.bind(( '127.0.0.1', 0 ))
+            address = probe.getsockname()
+            probe.close()
+            proc = subprocess.Popen( [ sys.executable, os.path.abspath( __file__ )] + forward
+                + [ '%s:%s' % address, '127.0.0.1', str( echo_port )],
+                stdout = subprocess.DEVNULL )
+            if not wait_listening( address, proc ):
+                print( 'pinhole bench: the forwarder did not start', file = sys.stderr )
+                return 1
+        for name in tests:
+            result = asyncio.run( bench_run( BENCH_TESTS[name], address, bopts ))
+            summary['tests'][name] = result
+            bench_report( name, result )
+    except KeyboardInterrupt:
+        return 1
+    finally:
+        if proc:
+            if proc.poll() is None:
+                proc.send_signal( signal.SIGINT )
+            try:
+                _, status, usage = os.wait4( proc.pid, 0 )
+                summary['forwarder_cpu_seconds'] = round( usage.ru_utime + usage.ru_stime, 3 )
+            except ChildProcessError:
+                pass
+        os.kill( server, signal.SIGKILL )
+        os.waitpid( server, 0 )
+
+    if 'forwarder_cpu_seconds' in summary:
+        print( '%-8s %.2fs' % ( 'cpu', summary['forwarder_cpu_seconds'] ))
+    print( json.dumps( summary ))
+    return 0
+
+
+def parse_target( spec, port ):
+    """split host[:port] or [v6addr]:port, port defaults to the listen port
+
+    a unix socket path comes back as ( path, None )"""
+    if '/' in spec:
+        return spec, None
+    if spec.startswith( '[' ):
+        host, _, rest = spec[1:].partition( ']' )
+        return host, int( rest[1:] ) if rest.startswith( ':' ) else port
+    if spec.count( ':' ) == 1:
+        host, newport = spec.split( ':' )
+        return host, int( newport )
+    return spec, port
+
+
+def parse_listen( spec ):
+    """a port number, or an addr:port, [v6addr]:port or unix path string"""
+    if '/' in spec:
+        return spec
+    host, port = parse_target( spec, None )
+    if port is None:
+        return int( spec )
+    return '[%s]:%s' % ( host, port ) if ':' in host else '%s:%s' % ( host, port )
+
+
+def listen_port( listen ):
+    """the port number of a listen address, None for a unix socket"""
+    if isinstance( listen, int ):
+        return listen
+    return parse_target( listen, None )[1]
+
+
+def listen_address( s ):
+    try:
+        return parse_listen( s )
+    except ValueError:
+        raise argparse.ArgumentTypeError( 'invalid listen address %r' % s )
+
+
+def bufsize( s ):
+    n = int( s )
+    if n < 1024:
+        raise argparse.ArgumentTypeError( 'buffer size must be at least 1024' )
+    return n
+
+
+def size( s ):
+    """a byte count, optionally with a k, m or g suffix"""
+    scale = { 'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30 }.get( s[-1:].lower(), 1 )
+    try:
+        n = float( s[:-1] if scale > 1 else s ) * scale
+    except ValueError:
+        raise argparse.ArgumentTypeError( 'invalid size %r' % s )
+    if n < 0:
+        raise argparse.ArgumentTypeError( 'size must not be negative' )
+    return n
+
+
+def rate( s ):
+    """bytes per second, optionally with a k, m or g suffix"""
+    return size( s )
+
+
+def tcp_options( s ):
+    """parse a --client-tcp or --backend-tcp list into { option: value }"""
+    spec = {}
+    for item in filter( None, s.split( ',' )):
+        name, _, value = item.partition( '=' )
+        try:
+            if name in ( 'nodelay', 'quickack' ) and not value:
+                spec[name] = True
+            elif name == 'keepalive':
+                spec[name] = [ int( v ) for v in value.split( ':' ) ] if value else []
+                if len( spec[name] ) > 3: raise ValueError
+            elif name in ( 'rcvbuf', 'sndbuf' ):
+                spec[name] = int( size( value ))
+            elif name == 'fastopen':
+                spec[name] = int( value ) if value else FASTOPEN_QUEUE
+            else:
+                raise ValueError
+        except ( ValueError, argparse.ArgumentTypeError ):
+            raise argparse.ArgumentTypeError( 'invalid TCP option %r' % item )
+    needs = { 'quickack': 'TCP_QUICKACK', 'fastopen': 'TCP_FASTOPEN' }
+    if spec.get( 'keepalive' ):
+        needs['keepalive'] = 'TCP_KEEPIDLE'
+    for name, const in needs.items():
+        if name in spec and not hasattr( socket, const ):
+            raise argparse.ArgumentTypeError( '%s is not supported on this platform' % name )
+    return spec
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description = 'Forward a local TCP port to another host.' )
+    parser.add_argument( '--engine', choices = ( 'thread', 'async' ),
+        help = 'thread: two threads per session, async: one event loop for all sessions'
+            ' (default thread, or async with --config)' )
+    parser.add_argument( '--config', metavar = 'FILE',
+        help = 'serve the listeners in this INI or TOML file, SIGHUP rereads it' )
+    parser.add_argument( '--no-splice', dest = 'splice', action = 'store_false',
+        default = SPLICE,
+        help = 'always copy through userspace instead of using splice(2)' )
+    parser.add_argument( '--bufsize', type = bufsize, default = BUFSIZE,
+        help = 'bytes read per syscall in each direction (default %(default)s)' )
+    parser.add_argument( '--workers', type = int, default = 0,
+        help = 'fork this many worker processes sharing the port with SO_REUSEPORT' )
+    parser.add_argument( '--backlog', type = int, default = socket.SOMAXCONN,
+        help = 'listen queue length, capped by net.core.somaxconn (default %(default)s)' )
+    parser.add_argument( '--pool', type = int, default = 0,
+        help = 'idle upstream connections to keep open ahead of new clients' )
+    parser.add_argument( '--pool-idle', type = float, default = 30,
+        help = 'seconds before an idle pooled connection is replaced (default %(default)s)' )
+    parser.add_argument( '--dns-ttl', type = float, default = 60,
+        help = 'seconds to cache the resolved target address (default %(default)s)' )
+    parser.add_argument( '--backend', action = 'append', default = [],
+        metavar = 'HOST[:PORT]',
+        help = 'forward to this backend as well as host, may be repeated' )
+    parser.add_argument( '--balance', choices = Balancer.policies, default = 'roundrobin',
+        help = 'how sessions are spread over backends (default %(default)s)' )
+    parser.add_argument( '--health-interval', type = float, default = 5,
+        help = 'seconds between backend health checks, 0 to disable (default %(default)s)' )
+    parser.add_argument( '--idle-timeout', type = float, default = 0, metavar = 'SECONDS',
+        help = 'close sessions that move no data for this long, 0 for never' )
+    parser.add_argument( '--session-timeout', type = float, default = 0, metavar = 'SECONDS',
+        help = 'close sessions open for longer than this, 0 for never' )
+    parser.add_argument( '--proxy-protocol', type = int, choices = ( 1, 2 ),
+        help = 'send a PROXY protocol header of this version to backends' )
+    parser.add_argument( '--udp', action = 'store_true',
+        help = 'forward UDP datagrams instead of TCP sessions' )
+    parser.add_argument( '--high-water', type = size, default = 0, metavar = 'BYTES',
+        help = 'most bytes each session direction may have waiting to be sent, eg. 256k' )
+    parser.add_argument( '--low-water', type = size, metavar = 'BYTES',
+        help = 'unsent bytes a receiver must drain below before more is read for it'
+            ' (default half of --high-water)' )
+    parser.add_argument( '--memory-budget', type = size, default = 0, metavar = 'BYTES',
+        help = 'relay buffer bytes shared by every session, eg. 64m, 0 for unlimited' )
+    parser.add_argument( '--max-sessions', type = int, default = 0, metavar = 'N',
+        help = 'TCP sessions open at once in the whole process, 0 for unlimited' )
+    parser.add_argument( '--max-client-sessions', type = int, default = 0, metavar = 'N',
+        help = 'TCP sessions open at once from one client address, 0 for unlimited' )
+    parser.add_argument( '--client-conn-rate', type = float, default = 0, metavar = 'N',
+        help = 'new connections per second from one client address, 0 for unlimited' )
+    parser.add_argument( '--overflow', choices = ( 'reject', 'queue' ), default = 'reject',
+        help = 'what happens to connections over a limit (default %(default)s)' )
+    parser.add_argument( '--queue-timeout', type = float, default = 5, metavar = 'SECONDS',
+        help = 'how long --overflow queue holds a connection (default %(default)s)' )
+    parser.add_argument( '--client-tcp', type = tcp_options, default = {}, metavar = 'OPTS',
+        help = 'TCP options for client sockets, eg. nodelay,keepalive=60:10:5,rcvbuf=1m,fastopen' )
+    parser.add_argument( '--backend-tcp', type = tcp_options, default = {}, metavar = 'OPTS',
+        help = 'TCP options for upstream sockets, the same list as --client-tcp' )
+    parser.add_argument( '--rate-session', type = rate, default = 0, metavar = 'BYTES',
+        help = 'bytes per second each session may relay, eg. 512k, 0 for unlimited' )
+    parser.add_argument( '--rate-client', type = rate, default = 0, metavar = 'BYTES',
+        help = 'bytes per second shared by all sessions from one client address' )
+    parser.add_argument( '--rate-global', type = rate, default = 0, metavar = 'BYTES',
+        help = 'bytes per second shared by every session, split between --workers' )
+    parser.add_argument( '--drain-timeout', type = float, default = 30, metavar = 'SECONDS',
+        help = 'on SIGTERM wait this long for open sessions to finish (default %(default)s)' )
+    parser.add_argument( '--handoff', metavar = 'PATH',
+        help = 'unix socket for passing the listeners to a new pinhole on upgrade' )
+    parser.add_argument( '--capture', metavar = 'DIR|FILE.pcapng',
+        help = 'record session data to files in DIR, or to one pcapng file' )
+    parser.add_argument( '--capture-size', type = size, default = 64 << 20, metavar = 'BYTES',
+        help = 'size at which a capture file is moved aside and a new one started (default 64m)' )
+    parser.add_argument( '--metrics', metavar = '[HOST:]PORT|PATH',
+        help = 'serve prometheus metrics over HTTP on this port or unix socket' )
+    parser.add_argument( '--log-level', choices = ( 'debug', 'info', 'warning', 'error' ),
+        default = 'info', help = 'least severe events to log (default %(default)s)' )
+    parser.add_argument( '--log-sample', type = int, default = 1, metavar = 'N',
+        help = 'log only one in N session open/close events' )
+    parser.add_argument( '--log-json', action = 'store_true',
+        help = 'log one JSON object per line' )
+    parser.add_argument( '--log-file', metavar = 'PATH',
+        help = 'append the log here instead of stdout' )
+    parser.add_argument( 'port', metavar = 'listen', type = listen_address, nargs = '?' )
+    parser.add_argument( 'newhost', metavar = 'host', nargs = '?' )
+    parser.add_argument( 'newport', type = int, nargs = '?' )
+    return parser
+
+
+def default_opts():
+    return make_parser().parse_args( [] )
+
+
+def main( argv = None ):
+    """the pinhole command line"""
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == [ 'bench' ]:
+        return bench( argv[1:] )
+
+    parser = make_parser()
+    args = parser.parse_args( argv )
+
+    print( 'Starting Pinhole' )
+
+    if args.engine is None:
+        args.engine = 'async' if args.config else 'thread'
+
+    if args.config:
+        if args.port is not None or args.backend:
+            parser.error( '--config replaces listen, host and --backend' )
+        try:
+            mappings = load_config( args )
+        except ( OSError, ValueError ) as e:
+            parser.error( '%s: %s' % ( args.config, e ))
+    elif args.port is not None:
+        try:
+            mappings = [( args.port, targets_of( args ), args )]
+        except ValueError as e:
+            parser.error( str( e ))
+    else:
+        mappings = [( 8080, [( 'google.com', 80 )], args ), ( 8081, [( 'google.com', 443 )], args )]
+
+    if args.workers:
+        if args.handoff:
+            parser.error( '--handoff does not work with --workers' )
+        if not hasattr( socket, 'SO_REUSEPORT' ):
+            parser.error( '--workers needs SO_REUSEPORT' )
+        supervise( mappings, args )
+    else:
+        serve( mappings, args )
+
+
+if __name__ == '__main__':
+    sys.exit( main() )